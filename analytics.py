@@ -0,0 +1,197 @@
+import glob
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+from checkpoint import record_question_id
+from ingestion import file_hash, read_partition
+from results_sink import atomic_write_json
+
+DEFAULT_RESULTS_STORE = '.results_store'
+MANIFEST = 'manifest.json'
+
+# Colonne tenute per ogni domanda: quanto serve alle query, non il testo di domanda e risposte
+COLUMNS = ['Question ID', 'Category', 'Model', 'Correct Answer', 'Model Answer', 'Is Correct', 'Percentage Correct', 'Source']
+SCHEMA = pa.schema([
+    ('Question ID', pa.string()),
+    ('Category', pa.string()),
+    ('Model', pa.string()),
+    ('Correct Answer', pa.string()),
+    ('Model Answer', pa.string()),
+    ('Is Correct', pa.bool_()),
+    ('Percentage Correct', pa.float64()),
+    ('Source', pa.string()),
+])
+
+
+def result_files(results_dirs):
+    # Solo i file finali: i shard della sweep parallela vengono uniti nel file del foglio a fine run
+    files = set()
+    for results_dir in results_dirs:
+        for path in glob.glob(os.path.join(results_dir, '**', '*_MC.json'), recursive=True):
+            if '.shard-' not in os.path.basename(path):
+                files.add(os.path.abspath(path))
+    return sorted(files)
+
+
+def percentage(value):
+    # Accetta 0.45, 45, "45%" e "45,5"; None se il valore non è numerico
+    if value is None:
+        return None
+    try:
+        return float(str(value).strip().rstrip('%').replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def _as_text(value):
+    return None if value is None else str(value)
+
+
+def records_table(records, source):
+    rows = {column: [] for column in COLUMNS}
+    for record in records:
+        rows['Question ID'].append(record_question_id(record))
+        rows['Category'].append(_as_text(record.get('Category')))
+        rows['Model'].append(_as_text(record.get('Models')))
+        rows['Correct Answer'].append(_as_text(record.get('Correct Answer')))
+        rows['Model Answer'].append(_as_text(record.get('Model Answer')))
+        rows['Is Correct'].append(bool(record.get('Is Correct')))
+        rows['Percentage Correct'].append(percentage(record.get('Percentage Correct')))
+        rows['Source'].append(source)
+    return pa.Table.from_pydict(rows, schema=SCHEMA)
+
+
+class ResultsStore:
+    # Archivio colonnare degli esiti per domanda: una partizione Arrow per file *_MC.json.
+    # Il manifest registra mtime, dimensione e hash di ogni file, così update() rilegge solo i file nuovi o modificati.
+
+    def __init__(self, store_dir=DEFAULT_RESULTS_STORE):
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, MANIFEST)
+        self.files = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.files = json.load(f)['files']
+
+    def _partition_path(self, entry):
+        return os.path.join(self.store_dir, entry['partition'])
+
+    def _write_partition(self, path, digest):
+        with open(path, 'r') as f:
+            records = json.load(f)
+        table = records_table(records, os.path.basename(path))
+        filename = f"{digest[:16]}.arrow"
+        with pa.OSFile(os.path.join(self.store_dir, filename), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        return filename, table.num_rows
+
+    def update(self, results_dirs):
+        os.makedirs(self.store_dir, exist_ok=True)
+        paths = result_files(results_dirs)
+        added = changed = unchanged = 0
+        for path in paths:
+            stat = os.stat(path)
+            entry = self.files.get(path)
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                unchanged += 1
+                continue
+            # mtime cambiato ma contenuto identico (es. file copiato): basta aggiornare il manifest
+            digest = file_hash(path)
+            if entry is not None and entry['hash'] == digest:
+                entry.update(mtime=stat.st_mtime, size=stat.st_size)
+                unchanged += 1
+                continue
+            try:
+                partition, rows = self._write_partition(path, digest)
+            except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+                print(f"Attenzione: {path} non è un file di risultati valido, ignorato ({e})")
+                continue
+            if entry is None:
+                added += 1
+            else:
+                changed += 1
+                if entry['partition'] != partition and not self._shared(entry['partition'], path):
+                    os.remove(self._partition_path(entry))
+            self.files[path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest, 'partition': partition, 'rows': rows}
+
+        # File rimossi (o fuori dalle cartelle indicate in questa run): escono dall'archivio
+        present = set(paths)
+        removed = [path for path in self.files if path not in present]
+        for path in removed:
+            entry = self.files.pop(path)
+            if not self._shared(entry['partition'], path) and os.path.exists(self._partition_path(entry)):
+                os.remove(self._partition_path(entry))
+
+        # Il manifest viene scritto per ultimo: una partizione senza voce nel manifest viene solo sovrascritta
+        atomic_write_json(self.manifest_path, {'files': self.files})
+        print(f"Archivio risultati {self.store_dir}: {added} file nuovi, {changed} modificati, {len(removed)} rimossi, {unchanged} invariati")
+
+    def _shared(self, partition, path):
+        # Due file con lo stesso contenuto condividono la partizione
+        return any(entry['partition'] == partition for other, entry in self.files.items() if other != path)
+
+    def load(self):
+        if not self.files:
+            return pd.DataFrame(columns=COLUMNS)
+        # Ogni voce ha la propria colonna Source, quindi i file identici si leggono una volta e si rinominano
+        frames = []
+        for path, entry in self.files.items():
+            df = read_partition(self._partition_path(entry))
+            df['Source'] = os.path.basename(path)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+
+def filter_results(df, models=None, categories=None):
+    if models:
+        df = df[df['Model'].isin(models) | df['Model'].str.split('/').str[-1].isin(models)]
+    if categories:
+        df = df[df['Category'].isin(categories)]
+    return df
+
+
+def accuracy_by_model_category(df):
+    # Accuratezza per modello (righe) e categoria (colonne), più il totale per modello
+    table = df.pivot_table(index='Model', columns='Category', values='Is Correct', aggfunc='mean')
+    table['Totale'] = df.groupby('Model')['Is Correct'].mean()
+    return table
+
+
+def model_agreement(df):
+    # Frazione di domande a cui due modelli danno la stessa risposta, tra quelle a cui entrambi hanno risposto.
+    # Lo stesso risultato presente in più file (es. cartelle copiate) conta una volta.
+    answers = df.dropna(subset=['Model Answer']).drop_duplicates(['Question ID', 'Model']).pivot(index='Question ID', columns='Model', values='Model Answer')
+    models = list(answers.columns)
+    agreement = pd.DataFrame(index=models, columns=models, dtype=float)
+    for first in models:
+        for second in models:
+            both = answers[first].notna() & answers[second].notna()
+            agreement.loc[first, second] = (answers.loc[both, first] == answers.loc[both, second]).mean() if both.any() else float('nan')
+    return agreement
+
+
+def difficulty_buckets(df, bins=5):
+    # Accuratezza dei modelli per fascia di difficoltà, misurata dalla percentuale di risposte corrette umane.
+    # Le percentuali espresse in 0-100 vengono riportate in 0-1.
+    df = df.dropna(subset=['Percentage Correct'])
+    human = df['Percentage Correct']
+    if human.max() > 1:
+        human = human / 100
+    edges = [i / bins for i in range(bins + 1)]
+    buckets = pd.cut(human, edges, include_lowest=True)
+    table = df.groupby([buckets, 'Model'], observed=True)['Is Correct'].mean().unstack('Model')
+    questions = buckets.loc[df.drop_duplicates('Question ID').index].value_counts()
+    table.insert(0, 'Domande', questions)
+    table.index.name = 'Percentage Correct'
+    return table
+
+
+QUERIES = {
+    'accuracy': accuracy_by_model_category,
+    'agreement': model_agreement,
+    'difficulty': difficulty_buckets,
+}
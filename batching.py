@@ -0,0 +1,233 @@
+import gc
+from collections import Counter
+
+import torch
+from transformers import BatchEncoding
+
+# Limiti per la scelta automatica del batch size (--batch_size auto)
+MAX_AUTO_BATCH_SIZE = 64
+CPU_AUTO_BATCH_SIZE = 4
+AUTO_MEMORY_FRACTION = 0.8
+# Batch adattivo: il limite di righe raddoppia dopo questi blocchi consecutivi senza OOM
+RAMP_AFTER = 8
+# Il tetto dopo un OOM viene rimosso solo se la memoria libera supera di questa frazione quella misurata all'OOM
+CEILING_RELEASE_MARGIN = 0.1
+
+
+def parse_batch_size(value):
+    # Valore di --batch_size: un intero positivo oppure 'auto'
+    if str(value).lower() == 'auto':
+        return 'auto'
+    batch_size = int(value)
+    if batch_size < 1:
+        raise ValueError(f"batch_size deve essere >= 1, ricevuto {batch_size}")
+    return batch_size
+
+
+def prepare_tokenizer_for_batching(text_gen_pipeline):
+    # I modelli decoder-only vanno paddati a sinistra, altrimenti la generazione
+    # continua dopo i token di padding. Llama 3 e Mistral non hanno un pad token.
+    tokenizer = text_gen_pipeline.tokenizer
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    generation_config = getattr(text_gen_pipeline.model, 'generation_config', None)
+    if generation_config is not None and generation_config.pad_token_id is None:
+        generation_config.pad_token_id = tokenizer.pad_token_id
+
+
+def pad_token_ids(token_ids, pad_token_id):
+    # Batch di prompt già tokenizzati, paddati a sinistra come li produrrebbe il tokenizer
+    longest = max(len(ids) for ids in token_ids)
+    input_ids = [[pad_token_id] * (longest - len(ids)) + ids for ids in token_ids]
+    attention_mask = [[0] * (longest - len(ids)) + [1] * len(ids) for ids in token_ids]
+    return BatchEncoding({'input_ids': torch.tensor(input_ids), 'attention_mask': torch.tensor(attention_mask)})
+
+
+def kv_cache_bytes_per_token(model):
+    # Stima della memoria della KV cache per token: 2 (K e V) x layer x head kv x dim head x byte
+    config = model.config
+    num_layers = config.num_hidden_layers
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, 'num_key_value_heads', None) or num_heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // num_heads
+    dtype_bytes = torch.finfo(model.dtype).bits // 8 if model.dtype.is_floating_point else 2
+    return 2 * num_layers * num_kv_heads * head_dim * dtype_bytes
+
+
+def auto_token_budget(text_gen_pipeline):
+    # Token totali (prompt + generazione, somma sul batch) la cui KV cache entra nella memoria GPU libera
+    model = text_gen_pipeline.model
+    if not torch.cuda.is_available() or model.device.type != 'cuda':
+        return None
+    free_bytes, _ = torch.cuda.mem_get_info(model.device)
+    # La memoria riservata dall'allocatore di PyTorch ma non in uso è riutilizzabile, anche se il driver non la vede libera
+    free_bytes += torch.cuda.memory_reserved(model.device) - torch.cuda.memory_allocated(model.device)
+    return int(free_bytes * AUTO_MEMORY_FRACTION // kv_cache_bytes_per_token(model))
+
+
+def resolve_batch_limits(batch_size, max_batch_tokens, text_gen_pipeline):
+    # Con 'auto' il numero di righe per batch è solo un tetto: il limite vero è il budget di token
+    if batch_size != 'auto':
+        return batch_size, max_batch_tokens
+    budget = auto_token_budget(text_gen_pipeline)
+    if budget is None:
+        return CPU_AUTO_BATCH_SIZE, max_batch_tokens
+    return MAX_AUTO_BATCH_SIZE, max_batch_tokens or budget
+
+
+def schedule_by_length(lengths, max_batch_size, max_batch_tokens=None, reserve_tokens=0):
+    # Ordina i prompt per lunghezza e li raggruppa in batch di lunghezza simile. Un batch costa
+    # righe x (prompt più lungo + reserve_tokens) e non deve superare max_batch_tokens.
+    # Restituisce liste di indici nelle posizioni originali.
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current = []
+    current_max = 0
+    for index in order:
+        longest = max(current_max, lengths[index])
+        too_many = len(current) >= max_batch_size
+        too_long = max_batch_tokens and (len(current) + 1) * (longest + reserve_tokens) > max_batch_tokens
+        if current and (too_many or too_long):
+            batches.append(current)
+            current = []
+            longest = lengths[index]
+        current.append(index)
+        current_max = longest
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padding_efficiency(lengths, batches):
+    # Frazione dei token di prompt elaborati che non sono padding
+    real_tokens = sum(lengths[i] for batch in batches for i in batch)
+    padded_tokens = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return real_tokens / padded_tokens if padded_tokens else 1.0
+
+
+def iter_batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def is_out_of_memory(error):
+    # OOM della GPU, oppure allocazione fallita su CPU/MPS (RuntimeError generico con il messaggio dell'allocatore)
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def release_cached_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class AdaptiveBatcher:
+    # Esegue i batch già schedulati in blocchi che rispettano il limite di righe corrente e la memoria libera.
+    # A un OOM il blocco viene diviso a metà e rieseguito e il limite scende; dopo ramp_after blocchi
+    # consecutivi riusciti il limite raddoppia, fino al batch size richiesto ma sempre sotto la dimensione più
+    # piccola che ha dato OOM. Quel tetto cade solo se la memoria libera cresce rispetto al momento dell'OOM.
+    # token_budget: funzione che restituisce i token che entrano in memoria in questo momento (None su CPU).
+
+    def __init__(self, max_batch_size, reserve_tokens=0, token_budget=None, ramp_after=RAMP_AFTER):
+        self.max_batch_size = max_batch_size
+        self.limit = max_batch_size
+        self.reserve_tokens = reserve_tokens
+        self.token_budget = token_budget
+        self.ramp_after = ramp_after
+        self.successes = 0
+        self.failed_size = None
+        self.failed_budget = None
+        self.sizes = Counter()
+        self.backoffs = 0
+        self.ramps = 0
+        self.memory_splits = 0
+
+    def run(self, indices, lengths, infer):
+        # infer(blocco) restituisce un output per indice del blocco.
+        # Risultato: ({indice: output}, {indice: eccezione}) per le domande riuscite e fallite.
+        outputs, errors = {}, {}
+        pending = list(indices)
+        while pending:
+            budget = self.token_budget() if self.token_budget is not None else None
+            self._release_ceiling(budget)
+            size = self._chunk_size(pending, lengths, budget)
+            chunk, pending = pending[:size], pending[size:]
+            self._run(chunk, infer, outputs, errors)
+        return outputs, errors
+
+    def _release_ceiling(self, budget):
+        # Più memoria libera che al momento dell'OOM (es. un altro processo ha terminato): si può riprovare a crescere
+        if self.failed_size is None or budget is None or self.failed_budget is None:
+            return
+        if budget > self.failed_budget * (1 + CEILING_RELEASE_MARGIN):
+            print(f"Batch adattivo: memoria libera aumentata ({self.failed_budget} -> {budget} token), "
+                  f"rimosso il tetto sotto {self.failed_size} righe")
+            self.failed_size = None
+            self.failed_budget = None
+
+    def _chunk_size(self, indices, lengths, budget):
+        size = min(self.limit, len(indices))
+        if budget and size > 1:
+            fitting = size
+            while fitting > 1 and fitting * (max(lengths[index] for index in indices[:fitting]) + self.reserve_tokens) > budget:
+                fitting -= 1
+            if fitting < size:
+                self.memory_splits += 1
+                size = fitting
+        return size
+
+    def _run(self, chunk, infer, outputs, errors):
+        # Dentro il blocco except il traceback dell'OOM tiene vivi i frame del forward fallito, e con essi
+        # KV cache e attivazioni del blocco: si registra solo il messaggio e si libera la memoria dopo averlo lasciato
+        out_of_memory = None
+        try:
+            results = infer(chunk)
+        except Exception as e:
+            if not is_out_of_memory(e):
+                # Anche qui senza traceback: l'errore resta fino allo stadio di scrittura
+                errors.update((index, e.with_traceback(None)) for index in chunk)
+                return
+            out_of_memory = str(e)
+        if out_of_memory is not None:
+            release_cached_memory()
+            if len(chunk) == 1:
+                print(f"Batch adattivo: memoria insufficiente anche per una sola domanda ({out_of_memory})")
+                errors[chunk[0]] = MemoryError(out_of_memory)
+                return
+            half = (len(chunk) + 1) // 2
+            previous = self.limit
+            self.limit = min(self.limit, half)
+            if self.failed_size is None or len(chunk) < self.failed_size:
+                self.failed_size = len(chunk)
+                self.failed_budget = self.token_budget() if self.token_budget is not None else None
+            self.successes = 0
+            self.backoffs += 1
+            print(f"Batch adattivo: OOM con {len(chunk)} righe, limite da {previous} a {self.limit}: il blocco viene rieseguito diviso")
+            # Il resto del blocco segue il limite corrente, che può scendere ancora durante la ripetizione
+            remaining = chunk
+            while remaining:
+                part, remaining = remaining[:self.limit], remaining[self.limit:]
+                self._run(part, infer, outputs, errors)
+            return
+
+        outputs.update(zip(chunk, results))
+        self.sizes[len(chunk)] += 1
+        self.successes += 1
+        if self.successes >= self.ramp_after:
+            ceiling = self.max_batch_size if self.failed_size is None else min(self.max_batch_size, self.failed_size - 1)
+            if self.limit < ceiling:
+                previous = self.limit
+                self.limit = min(ceiling, self.limit * 2)
+                self.ramps += 1
+                print(f"Batch adattivo: {self.ramp_after} blocchi senza OOM, limite da {previous} a {self.limit}")
+            self.successes = 0
+
+    def report(self):
+        sizes = ', '.join(f"{size} righe x{count}" for size, count in sorted(self.sizes.items()))
+        ceiling = f", OOM da {self.failed_size} righe" if self.failed_size is not None else ""
+        print(f"Batch adattivo: blocchi eseguiti {sizes or '-'}; {self.backoffs} riduzioni per OOM, {self.ramps} aumenti, "
+              f"{self.memory_splits} blocchi ridotti per la memoria libera, limite finale {self.limit}/{self.max_batch_size}{ceiling}")
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+
+from results_sink import journal_filename, read_journal
+
+OPTION_KEYS = ['A', 'B', 'C', 'D', 'E']
+
+
+def question_id(category, question, answers, correct_answer_key):
+    # Id stabile di una domanda: dipende solo dal foglio e dal contenuto della riga, non dalla sua posizione
+    payload = json.dumps([category, str(question), [answers[key] for key in OPTION_KEYS], correct_answer_key], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def record_question_id(record):
+    # I risultati scritti prima dell'introduzione di 'Question ID' hanno comunque tutti i campi per ricalcolarlo
+    if 'Question ID' in record:
+        return record['Question ID']
+    answers = {key: record[f'Answer {key}'] for key in OPTION_KEYS}
+    return question_id(record['Category'], record['Question'], answers, record['Correct Answer'])
+
+
+def index_filename(json_filename):
+    return os.path.splitext(json_filename)[0] + '.index.jsonl'
+
+
+def load_previous_results(json_filename):
+    # Risultati già ottenuti per il foglio: dal giornale di una run interrotta, altrimenti dal JSON finale
+    if os.path.exists(journal_filename(json_filename)):
+        return read_journal(journal_filename(json_filename)), 'journal'
+    if os.path.exists(json_filename):
+        with open(json_filename, 'r') as f:
+            return json.load(f), 'json'
+    return [], None
+
+
+class CompletionIndex:
+    # Indice append-only dello stato di ogni domanda (done / failed), letto una volta all'avvio.
+    # Sopravvive al JSON finale, così --retry_failed può riprendere anche fogli già completati.
+
+    def __init__(self, path, reset=False):
+        # reset: il foglio riparte da zero (nessun risultato su disco), lo stato precedente non vale più
+        self.path = path
+        self.status = {}
+        if os.path.exists(path) and not reset:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.status[entry['id']] = entry['status']
+        self._file = open(path, 'w' if reset else 'a', encoding='utf-8')
+
+    def mark(self, question_ids, status):
+        lines = []
+        for qid in question_ids:
+            if self.status.get(qid) != status:
+                self.status[qid] = status
+                lines.append(json.dumps({'id': qid, 'status': status}))
+        if lines:
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+
+    def pending(self, question_ids, done, retry_failed=False):
+        # done: id dei risultati effettivamente su disco. Un 'done' dell'indice senza risultato (es. giornale
+        # troncato da un crash) non basta: dell'indice conta solo lo stato 'failed'
+        return [
+            qid for qid in question_ids
+            if qid not in done and (retry_failed or self.status.get(qid) != 'failed')
+        ]
+
+    def count(self, status):
+        return sum(1 for value in self.status.values() if value == status)
+
+    def close(self):
+        self._file.close()
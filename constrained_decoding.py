@@ -0,0 +1,67 @@
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from scoring import OPTION_LETTERS
+
+# Unico output ammesso in decodifica vincolata
+ANSWER_TEMPLATE = '{{"answer": "{letter}"}}'
+
+
+class AnswerGrammar:
+    # Le cinque risposte possibili, tokenizzate una volta per modello: la decodifica
+    # segue il trie di queste sequenze e si ferma alla graffa di chiusura
+
+    def __init__(self, tokenizer):
+        self.sequences = [
+            tokenizer.encode(ANSWER_TEMPLATE.format(letter=letter), add_special_tokens=False)
+            for letter in OPTION_LETTERS
+        ]
+        self.eos_token_id = tokenizer.eos_token_id
+        self.max_new_tokens = max(len(sequence) for sequence in self.sequences) + 1
+
+    def allowed_tokens(self, generated):
+        position = len(generated)
+        allowed = {
+            sequence[position] for sequence in self.sequences
+            if len(sequence) > position and sequence[:position] == generated
+        }
+        # Risposta completa (o riga già terminata nel batch): resta solo l'EOS
+        return sorted(allowed) if allowed else [self.eos_token_id]
+
+    def is_complete(self, generated):
+        return any(generated[:len(sequence)] == sequence for sequence in self.sequences)
+
+    def generation_kwargs(self):
+        # Processor e criterio di stop vanno creati per ogni chiamata: memorizzano la lunghezza del prompt
+        processor = AnswerLogitsProcessor(self)
+        return {
+            'logits_processor': LogitsProcessorList([processor]),
+            'stopping_criteria': StoppingCriteriaList([AnswerStoppingCriteria(processor)]),
+        }
+
+
+class AnswerLogitsProcessor(LogitsProcessor):
+    # Porta a -inf tutti i token che non continuano una delle risposte ammesse.
+    # Viene applicato prima di temperature/top-k/top-p, quindi il campionamento resta valido.
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        mask = torch.full_like(scores, float('-inf'))
+        for row, generated in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            mask[row, self.grammar.allowed_tokens(generated)] = 0
+        return scores + mask
+
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    def __init__(self, processor):
+        self.processor = processor
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.processor.prompt_length:].tolist()
+        done = [self.processor.grammar.is_complete(row) for row in generated]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
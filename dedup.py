@@ -0,0 +1,84 @@
+import hashlib
+import json
+from collections import Counter
+
+from script_MC_new import clean_text, output_filename
+from ingestion import normalize_sheet, OPTION_KEYS
+from checkpoint import load_previous_results
+
+
+def dedup_key(question, answers):
+    # Domanda normalizzata con clean_text e le cinque opzioni normalizzate (colonne Answer* Clean), nell'ordine:
+    # con le opzioni permutate la stessa lettera indicherebbe un'altra risposta
+    payload = json.dumps([clean_text(question), [answers[key] for key in OPTION_KEYS]], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class DedupIndex:
+    # Domande ripetute tra i fogli del file Excel. Il foglio canonico di una domanda è il primo, nell'ordine
+    # di elaborazione, che la contiene: lì la domanda viene inferita, negli altri fogli si copia la risposta.
+
+    def __init__(self, sheets):
+        self.canonical = {}
+        self.shared = set()
+        self.rows = 0
+        self.overlaps = Counter()
+        for sheet_name, df in sheets.items():
+            if 'Correct Key' not in df.columns:
+                if not all(f'Answer{key}' in df.columns for key in OPTION_KEYS) or 'Correct Answer' not in df.columns:
+                    continue
+                df = normalize_sheet(df)
+            seen = set()
+            for row in df.to_dict('records'):
+                key = dedup_key(row['Question'], {key: row[f'Answer{key} Clean'] for key in OPTION_KEYS})
+                self.rows += 1
+                canonical = self.canonical.setdefault(key, sheet_name)
+                if canonical != sheet_name and key not in seen:
+                    self.overlaps[(canonical, sheet_name)] += 1
+                    self.shared.add(key)
+                seen.add(key)
+        self.duplicates = sum(self.overlaps.values())
+
+    def report(self):
+        print(f"Deduplicazione: {self.rows} righe, {len(self.canonical)} domande distinte, "
+              f"{self.duplicates} ripetute in altri fogli ({self.duplicates / max(self.rows, 1):.1%} delle righe)")
+        for (canonical, sheet_name), count in self.overlaps.most_common(10):
+            print(f"   {count} domande di '{sheet_name}' già presenti in '{canonical}'")
+
+
+class SharedAnswers:
+    # Risposte di un modello alle domande ripetute, raccolte nel foglio canonico e copiate negli altri fogli.
+    # Le risposte dei fogli canonici già completati in run precedenti vengono lette dai loro file di output.
+
+    def __init__(self, index, model):
+        self.index = index
+        self.answers = {}
+        self.reused = 0
+        for sheet_name in {self.index.canonical[key] for key in self.index.shared}:
+            records, _ = load_previous_results(output_filename(sheet_name, model))
+            for record in records:
+                answers = {key: record[f'Answer {key}'] for key in OPTION_KEYS}
+                self.store(sheet_name, self.key(record['Question'], answers), record)
+
+    def key(self, question, answers):
+        return dedup_key(question, answers)
+
+    def lookup(self, category, key):
+        # Solo per le domande il cui foglio canonico è un altro; None se la risposta non c'è (es. richiesta fallita)
+        if key not in self.index.shared or self.index.canonical[key] == category:
+            return None
+        return self.answers.get(key)
+
+    def store(self, category, key, result):
+        if key in self.index.shared and self.index.canonical[key] == category:
+            answer = {'Model Answer': result['Model Answer'], 'Category': category}
+            if 'Answer Probabilities' in result:
+                answer['Answer Probabilities'] = result['Answer Probabilities']
+            self.answers[key] = answer
+
+    def count_reused(self, count):
+        self.reused += count
+
+    def report(self, model):
+        print(f"Deduplicazione per {model}: {self.reused} domande copiate da altri fogli invece di essere inferite "
+              f"(su {self.index.duplicates} ripetute)")
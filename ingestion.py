@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+from results_sink import atomic_write_json
+
+DEFAULT_WORKBOOK_CACHE = '.workbook_cache'
+OPTION_KEYS = ['A', 'B', 'C', 'D', 'E']
+MANIFEST = 'manifest.json'
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clean_column(series):
+    # Versione vettoriale di clean_text: stessa sequenza di strip, lower e sostituzioni
+    cleaned = series.astype(str).str.strip().str.lower().str.replace('\n', ' ', regex=False).str.replace(';', '', regex=False)
+    return cleaned.where(series.notna(), '')
+
+
+def normalize_sheet(df):
+    # Aggiunge le risposte normalizzate e la lettera della risposta corretta. Come answer2key,
+    # in caso di opzioni duplicate vince l'ultima lettera; None se la risposta corretta non è tra le opzioni.
+    df = df.copy()
+    correct = clean_column(df['Correct Answer'])
+    correct_key = pd.Series([None] * len(df), index=df.index, dtype=object)
+    for key in OPTION_KEYS:
+        df[f'Answer{key} Clean'] = clean_column(df[f'Answer{key}'])
+        correct_key = correct_key.where(df[f'Answer{key} Clean'] != correct, key)
+    df['Correct Answer Clean'] = correct
+    df['Correct Key'] = correct_key
+    return df
+
+
+def _to_arrow(df):
+    # Le colonne object con tipi misti (es. numeri tra i testi) non sono convertibili in Arrow: diventano stringhe
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(lambda value: value if value is None or pd.isna(value) else str(value))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def read_partition(path):
+    # File Arrow IPC non compressi: letti tramite memory map, senza copiare i buffer numerici
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+
+def build_workbook_cache(excel_path, cache_dir=DEFAULT_WORKBOOK_CACHE):
+    # Converte il file Excel una volta sola: una partizione Arrow per foglio, in una cartella
+    # identificata dall'hash del file, così ogni modifica all'Excel invalida la cache
+    target = os.path.join(cache_dir, file_hash(excel_path)[:16])
+    manifest_path = os.path.join(target, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return target, json.load(f)
+
+    print(f"Conversione di {excel_path} in {target}...")
+    os.makedirs(target, exist_ok=True)
+    sheets = pd.read_excel(excel_path, sheet_name=None)
+    manifest = {'excel_path': os.path.abspath(excel_path), 'sheets': {}}
+    for position, (sheet_name, df) in enumerate(sheets.items()):
+        if all(f'Answer{key}' in df.columns for key in OPTION_KEYS) and 'Correct Answer' in df.columns:
+            df = normalize_sheet(df)
+        filename = f"{position:03d}.arrow"
+        table = _to_arrow(df)
+        with pa.OSFile(os.path.join(target, filename), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        manifest['sheets'][sheet_name] = filename
+    # Il manifest viene scritto per ultimo: la sua presenza indica una cache completa
+    atomic_write_json(manifest_path, manifest)
+    return target, manifest
+
+
+def load_workbook(excel_path, sheet_names=None, cache_dir=DEFAULT_WORKBOOK_CACHE):
+    # Restituisce {nome foglio: DataFrame} dalla cache; sheet_names=None per tutti i fogli
+    target, manifest = build_workbook_cache(excel_path, cache_dir)
+    if sheet_names is None:
+        sheet_names = list(manifest['sheets'])
+    missing = [name for name in sheet_names if name not in manifest['sheets']]
+    if missing:
+        raise ValueError(f"Fogli non trovati in {excel_path}: {', '.join(missing)}")
+    return {name: read_partition(os.path.join(target, manifest['sheets'][name])) for name in sheet_names}
+
+
+def sheet_names(excel_path, cache_dir=DEFAULT_WORKBOOK_CACHE):
+    return list(build_workbook_cache(excel_path, cache_dir)[1]['sheets'])
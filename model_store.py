@@ -0,0 +1,92 @@
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import pipeline
+
+from response_cache import model_revision
+from results_sink import creation_mode
+
+DEFAULT_MODEL_STORE = '.model_store'
+MANIFEST = 'store.json'
+
+# Quantizzazione applicata al primo caricamento dal checkpoint originale
+QUANTIZATION_CONFIGS = {
+    '4bit': {"load_in_4bit": True},
+    '8bit': {"load_in_8bit": True},
+    'none': None,
+}
+
+
+def store_path(store_dir, model, quantization):
+    # Una cartella per modello e quantizzazione; i percorsi locali diventano nomi piatti
+    name = model.strip('/').replace('/', '--')
+    return os.path.join(store_dir, f"{name}-{quantization}")
+
+
+def peak_rss_mb():
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def report_load(model, source, seconds):
+    message = f"Modello {model} caricato da {source} in {seconds:.1f}s, RSS di picco {peak_rss_mb():.0f} MB"
+    if torch.cuda.is_available():
+        message += f", memoria GPU di picco {torch.cuda.max_memory_allocated() / (1024 * 1024):.0f} MB"
+    print(message)
+
+
+def save_to_store(text_gen_pipeline, model, quantization, path):
+    # Salva i pesi già quantizzati in safetensors: il prossimo caricamento non rilegge il checkpoint fp16
+    # e non ripete la quantizzazione. Scrittura in una cartella temporanea e rename, come per i JSON.
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        text_gen_pipeline.model.save_pretrained(tmp_path, safe_serialization=True)
+        text_gen_pipeline.tokenizer.save_pretrained(tmp_path)
+        manifest = {'model': model, 'quantization': quantization, 'revision': model_revision(text_gen_pipeline)}
+        with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=4)
+        # mkdtemp crea la cartella con permessi 0700: la cartella dei modelli può essere condivisa
+        os.chmod(tmp_path, creation_mode(0o777))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        # Es. quantizzazione non serializzabile con questa versione di bitsandbytes, o un altro processo
+        # ha già salvato lo stesso modello: si continua con il modello già in memoria
+        print(f"Attenzione: modello non salvato in {path}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    print(f"Modello salvato in {path} in {time.perf_counter() - start:.1f}s")
+
+
+def load_pipeline(model, quantization='4bit', store_dir=DEFAULT_MODEL_STORE, use_store=True):
+    path = store_path(store_dir, model, quantization)
+    start = time.perf_counter()
+    if use_store and os.path.exists(os.path.join(path, MANIFEST)):
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        # I safetensors vengono letti tramite memory map; la configurazione salvata contiene già la quantizzazione
+        text_gen_pipeline = pipeline("text-generation",
+                                     model=path,
+                                     model_kwargs={"torch_dtype": torch.float16},
+                                    )
+        # Stessa revisione del checkpoint originale: le chiavi della cache delle risposte non cambiano
+        text_gen_pipeline.model.config._commit_hash = manifest['revision']
+        report_load(model, path, time.perf_counter() - start)
+        return text_gen_pipeline
+
+    model_kwargs = {"torch_dtype": torch.float16}
+    if QUANTIZATION_CONFIGS[quantization] is not None:
+        model_kwargs["quantization_config"] = QUANTIZATION_CONFIGS[quantization]
+    text_gen_pipeline = pipeline("text-generation", model=model, model_kwargs=model_kwargs)
+    report_load(model, 'checkpoint originale', time.perf_counter() - start)
+    if use_store:
+        save_to_store(text_gen_pipeline, model, quantization, path)
+    return text_gen_pipeline
@@ -0,0 +1,150 @@
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+import torch
+
+from script_MC_new import initialize_model, release_model, process_sheet, output_filename, open_response_cache
+from results_sink import journal_filename, atomic_write_json
+from checkpoint import index_filename
+from ingestion import load_workbook
+
+DEFAULT_SHARD_SIZE = 50
+
+
+def shard_filename(json_filename, start, end):
+    base, extension = os.path.splitext(json_filename)
+    return f"{base}.shard-{start:05d}-{end:05d}{extension}"
+
+
+def plan_shards(sheets, models, shard_size, retry_failed=False):
+    # Lista dei shard (modello, foglio, righe) in ordine di modello, così ogni worker ricarica il modello il meno possibile.
+    # Un foglio con un output (anche parziale) della run seriale resta un unico shard sul file finale.
+    shards, groups = [], {}
+    for model in models:
+        for sheet_name, df in sheets.items():
+            final = output_filename(sheet_name, model)
+            if os.path.exists(final) and not retry_failed:
+                continue
+            if os.path.exists(final) or os.path.exists(journal_filename(final)) or len(df) <= shard_size:
+                ranges = [(0, len(df), final)]
+            else:
+                ranges = [
+                    (start, min(start + shard_size, len(df)), shard_filename(final, start, min(start + shard_size, len(df))))
+                    for start in range(0, len(df), shard_size)
+                ]
+            groups[(model, sheet_name)] = [filename for _, _, filename in ranges]
+            for start, end, filename in ranges:
+                shards.append({'model': model, 'sheet': sheet_name, 'start': start, 'end': end, 'filename': filename})
+    return shards, groups
+
+
+def merge_shards(json_filename, shard_files):
+    # Concatena i shard nell'ordine del foglio nel file finale e ne unisce gli indici delle domande
+    if shard_files == [json_filename]:
+        return
+    existing = [filename for filename in shard_files if os.path.exists(filename)]
+    if not existing:
+        return
+    records = []
+    for filename in existing:
+        with open(filename, 'r') as f:
+            records.extend(json.load(f))
+    with open(index_filename(json_filename), 'a', encoding='utf-8') as index:
+        for filename in existing:
+            if os.path.exists(index_filename(filename)):
+                with open(index_filename(filename), 'r', encoding='utf-8') as f:
+                    index.write(f.read())
+    atomic_write_json(json_filename, records)
+    for filename in existing:
+        os.remove(filename)
+        if os.path.exists(index_filename(filename)):
+            os.remove(index_filename(filename))
+    print(f"Uniti {len(existing)} shard in {json_filename} ({len(records)} risultati)")
+
+
+def worker_loop(worker_id, shards, results, excel_path, workbook_cache, threads, gpu, cache_options, model_options, options):
+    # Ogni worker possiede un'istanza del modello e preleva shard dalla coda finché non riceve None
+    if gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    torch.set_num_threads(threads)
+    response_cache = open_response_cache(**cache_options)
+    sheets = {}
+    while True:
+        shard = shards.get()
+        if shard is None:
+            break
+        start = time.perf_counter()
+        try:
+            if shard['sheet'] not in sheets:
+                sheets[shard['sheet']] = load_workbook(excel_path, [shard['sheet']], workbook_cache)[shard['sheet']]
+            df = sheets[shard['sheet']].iloc[shard['start']:shard['end']]
+            print(f"[worker {worker_id}] '{shard['sheet']}' righe {shard['start']}-{shard['end']} con {shard['model']}")
+            text_gen_pipeline = initialize_model(shard['model'], **model_options)
+            process_sheet(df, shard['sheet'], shard['model'], shard['filename'], text_gen_pipeline, response_cache=response_cache, **options)
+            del text_gen_pipeline
+            results.put((shard, worker_id, None, time.perf_counter() - start))
+        except Exception as e:
+            results.put((shard, worker_id, str(e), time.perf_counter() - start))
+    release_model()
+    if response_cache is not None:
+        response_cache.close()
+
+
+def run_parallel_sweep(excel_path, sheets, models, workers, threads_per_worker=0, shard_size=DEFAULT_SHARD_SIZE, gpus=None, workbook_cache=None, cache_options=None, model_options=None, **options):
+    shards, groups = plan_shards(sheets, models, shard_size, options.get('retry_failed', False))
+    if not shards:
+        print("Nessun foglio da elaborare: tutti i file di output esistono già.")
+        return
+    workers = min(workers, len(shards))
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    print(f"{len(shards)} shard su {len(groups)} coppie modello x foglio, {workers} worker da {threads} thread"
+          + (f", GPU {' '.join(str(gpu) for gpu in gpus)}" if gpus else ""))
+
+    # spawn: i figli non ereditano lo stato CUDA del processo principale
+    context = multiprocessing.get_context('spawn')
+    shard_queue, result_queue = context.Queue(), context.Queue()
+    for shard in shards:
+        shard_queue.put(shard)
+    for _ in range(workers):
+        shard_queue.put(None)
+
+    processes = []
+    for worker_id in range(workers):
+        gpu = gpus[worker_id % len(gpus)] if gpus else None
+        process = context.Process(
+            target=worker_loop,
+            args=(worker_id, shard_queue, result_queue, excel_path, workbook_cache, threads, gpu, cache_options or {}, model_options or {}, options)
+        )
+        process.start()
+        processes.append(process)
+
+    start = time.perf_counter()
+    remaining = {key: len(files) for key, files in groups.items()}
+    failed = set()
+    completed = 0
+    while completed < len(shards):
+        try:
+            shard, worker_id, error, seconds = result_queue.get(timeout=5)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                print(f"Errore: tutti i worker sono terminati con {len(shards) - completed} shard non elaborati.")
+                break
+            continue
+        completed += 1
+        key = (shard['model'], shard['sheet'])
+        if error is not None:
+            print(f"Error in shard '{shard['sheet']}' {shard['start']}-{shard['end']} ({shard['model']}): {error}")
+            failed.add(key)
+        remaining[key] -= 1
+        if remaining[key] == 0 and key not in failed:
+            # Foglio completo: i shard vengono uniti nel file con il nome usuale
+            merge_shards(output_filename(shard['sheet'], shard['model']), groups[key])
+
+    for process in processes:
+        process.join()
+    if failed:
+        print(f"{len(failed)} coppie modello x foglio con shard falliti: i shard completati restano su disco e vengono ripresi alla prossima esecuzione.")
+    print(f"Sweep parallela completata in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,118 @@
+import copy
+import time
+
+import torch
+from transformers import DynamicCache, StoppingCriteriaList
+
+from scoring import OPTION_LETTERS, option_token_ids
+from profiling import PROFILE
+
+
+def common_prefix_length(sequences):
+    shortest = min(len(sequence) for sequence in sequences)
+    for position in range(shortest):
+        token = sequences[0][position]
+        if any(sequence[position] != token for sequence in sequences):
+            return position
+    return shortest
+
+
+class PrefixCache:
+    # KV cache del prefisso comune a tutti i prompt di un foglio (template del modello, system prompt,
+    # preambolo e categoria), calcolata una volta e riusata per ogni domanda: si fa il prefill solo del suffisso.
+
+    def __init__(self, text_gen_pipeline, token_ids):
+        # token_ids: prompt del foglio già tokenizzati
+        self.tokenizer = text_gen_pipeline.tokenizer
+        self.model = text_gen_pipeline.model
+        self.token_ids = token_ids
+        # Ogni prompt deve conservare almeno un token di suffisso per produrre i logit del passo successivo
+        self.prefix_length = min(common_prefix_length(self.token_ids), min(len(ids) for ids in self.token_ids) - 1)
+        self.reused = 0
+        self.suffix_tokens = 0
+
+        start = time.perf_counter()
+        self.cache = DynamicCache()
+        if self.prefix_length > 0:
+            with torch.inference_mode():
+                prefix_ids = torch.tensor([self.token_ids[0][:self.prefix_length]], device=self.model.device)
+                self.model(input_ids=prefix_ids, past_key_values=self.cache, use_cache=True)
+        self.prefill_seconds = time.perf_counter() - start
+        # Il prefill del prefisso avviene una volta per foglio: nel profilo conta come quello delle domande
+        PROFILE.add_time('prefill', self.prefill_seconds)
+        PROFILE.count('prefill_tokens', self.prefix_length)
+
+    def _pad_token_id(self):
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id
+
+    def _cache_for_batch(self, batch_size):
+        cache = copy.deepcopy(self.cache)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    @torch.inference_mode()
+    def generate(self, index, messages, generation_kwargs):
+        # Restituisce l'output nello stesso formato della pipeline text-generation
+        ids = torch.tensor([self.token_ids[index]], device=self.model.device)
+        timer = PROFILE.first_token_timer()
+        if timer is not None:
+            generation_kwargs = {**generation_kwargs, 'stopping_criteria': StoppingCriteriaList(list(generation_kwargs.get('stopping_criteria', [])) + [timer])}
+        start = time.perf_counter()
+        output = self.model.generate(
+            input_ids=ids,
+            attention_mask=torch.ones_like(ids),
+            past_key_values=self._cache_for_batch(1),
+            pad_token_id=self._pad_token_id(),
+            **generation_kwargs
+        )
+        self.reused += 1
+        self.suffix_tokens += ids.shape[1] - self.prefix_length
+        generated = output[0, ids.shape[1]:]
+        if timer is not None and timer.first_token is not None:
+            # Come in generate_encoded: prefill (del solo suffisso) fino al primo token, decodifica per il resto
+            PROFILE.add_time('prefill', timer.first_token - start)
+            PROFILE.add_time('decode', time.perf_counter() - timer.first_token)
+            PROFILE.count('prefill_tokens', ids.shape[1] - self.prefix_length)
+            PROFILE.count('decode_tokens', max(0, int((generated != self._pad_token_id()).sum()) - 1))
+        generated_text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        return [{'generated_text': messages + [{'role': 'assistant', 'content': generated_text}]}]
+
+    @torch.inference_mode()
+    def score_options(self, indices):
+        # Suffissi paddati a sinistra, con position_ids espliciti che proseguono dal prefisso: il padding finisce
+        # tra prefisso e suffisso (mascherato) e l'ultimo token reale è l'ultima posizione di ogni riga
+        suffixes = [self.token_ids[index][self.prefix_length:] for index in indices]
+        longest = max(len(suffix) for suffix in suffixes)
+        pad_token_id = self._pad_token_id()
+        input_ids = torch.tensor([[pad_token_id] * (longest - len(suffix)) + suffix for suffix in suffixes], device=self.model.device)
+        suffix_mask = torch.tensor([[0] * (longest - len(suffix)) + [1] * len(suffix) for suffix in suffixes], device=self.model.device)
+        attention_mask = torch.cat([torch.ones(len(indices), self.prefix_length, dtype=suffix_mask.dtype, device=self.model.device), suffix_mask], dim=1)
+        position_ids = (self.prefix_length + suffix_mask.cumsum(dim=1) - 1).clamp(min=self.prefix_length)
+
+        # Solo prefill dei suffissi: un forward pass con il prefisso in cache e la testa del modello sull'ultima posizione
+        with PROFILE.stage('prefill'):
+            last_logits = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache_for_batch(len(indices)),
+                use_cache=True,
+                logits_to_keep=1
+            ).logits[:, -1, :]
+        option_logits = last_logits[:, option_token_ids(self.tokenizer)].float()
+        probabilities = torch.softmax(option_logits, dim=-1).tolist()
+
+        self.reused += len(indices)
+        self.suffix_tokens += sum(len(suffix) for suffix in suffixes)
+        PROFILE.count('prefill_tokens', sum(len(suffix) for suffix in suffixes))
+        return [dict(zip(OPTION_LETTERS, row)) for row in probabilities]
+
+    def report(self):
+        saved_tokens = self.prefix_length * self.reused
+        processed_tokens = saved_tokens + self.suffix_tokens
+        share = saved_tokens / processed_tokens if processed_tokens else 0.0
+        print(f"Prefisso condiviso: {self.prefix_length} token, prefill in {self.prefill_seconds:.2f}s, riusato {self.reused} volte. "
+              f"Token di prefill risparmiati: {saved_tokens} ({share:.1%}), tempo di prefill risparmiato stimato: {self.prefill_seconds * self.reused:.1f}s")
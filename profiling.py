@@ -0,0 +1,57 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import StoppingCriteria
+
+
+class Profile:
+    # Tempi per stadio e contatori (token, domande) raccolti durante process_sheet.
+    # Disattivato di default: lo attiva solo il benchmark, altrimenti le chiamate non fanno nulla.
+
+    def __init__(self):
+        self.enabled = False
+        self.seconds = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def reset(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = {}
+        self.counters = {}
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def first_token_timer(self):
+        return FirstTokenTimer() if self.enabled else None
+
+
+class FirstTokenTimer(StoppingCriteria):
+    # Non ferma mai la generazione: registra quando è pronto il primo token, cioè la fine del prefill
+    def __init__(self):
+        self.first_token = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+PROFILE = Profile()
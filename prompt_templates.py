@@ -0,0 +1,176 @@
+import functools
+
+from scoring import ANSWER_PREFIX
+
+# Testo della domanda. La parte fino a "Domanda Medica: " dipende solo dal foglio e viene preparata una volta,
+# per ogni riga si compilano solo domanda e risposte
+SHEET_HEADER = """Di seguito è riportata una domanda attinente al dominio medico. Sei un esperto di domande a risposta multipla nell'ambito clinico. Scegli la risposta corretta tra le cinque opzioni disponibili. \n
+            Categoria Medica: {category}\n
+            Domanda Medica: """
+
+ROW_BODY = """{question}\n
+            A: {A}\n
+            B: {B}\n
+            C: {C}\n
+            D: {D}\n
+            E: {E}\n
+            Istruzione:
+            Restituisci il tuo risultato in formato JSON contenente un campo 'answer' che indica la lettera corrispondente alla risposta corretta (A, B, C, D oppure E). Il campo non può mai essere vuoto."""
+
+# Segnaposto della domanda nei messaggi dei modelli
+CONTENT = '{content}'
+
+# Template esplicito per i tokenizer senza chat template (es. modelli base)
+FALLBACK_CHAT_TEMPLATE = (
+    "{{ bos_token if bos_token else '' }}"
+    "{% for message in messages %}{{ message['role'] | capitalize }}: {{ message['content'] }}\n\n{% endfor %}"
+    "{% if add_generation_prompt %}Assistant: {% endif %}"
+)
+
+
+class ModelTemplate:
+    # Messaggi inviati a un modello: coppie (ruolo, testo) in cui {content} è il testo della domanda.
+    # chat_template: template Jinja esplicito da usare se il tokenizer non ne ha uno.
+
+    def __init__(self, messages, chat_template=None):
+        self.messages = messages
+        self.chat_template = chat_template
+
+    def build(self, content):
+        return [{'role': role, 'content': text.replace(CONTENT, content)} for role, text in self.messages]
+
+
+ZEFIRO_SYSTEM_PROMPT = "Sei un assistente disponibile, rispettoso e onesto. " \
+                       "Rispondi sempre nel modo piu' utile possibile, pur essendo sicuro. " \
+                       "Le risposte non devono includere contenuti dannosi, non etici, razzisti, sessisti, tossici, pericolosi o illegali. " \
+                       "Assicurati che le tue risposte siano socialmente imparziali e positive. " \
+                       "Se una domanda non ha senso o non e' coerente con i fatti, spiegane il motivo invece di rispondere in modo non corretto. " \
+                       "Se non conosci la risposta a una domanda, non condividere informazioni false."
+
+ANITA_SYSTEM_PROMPT = "Tu sei un assistente medico esperto. Fornisci la migliore risposta possibile."
+
+TEMPLATES = {
+    "mistralai/Mistral-7B-Instruct-v0.1": ModelTemplate([('user', "<s>[INST] {content} [/INST]</s>")]),
+    "mii-community/zefiro-7b-base-ITA": ModelTemplate([('assistant', ZEFIRO_SYSTEM_PROMPT), ('user', CONTENT)]),
+    "BioMistral/BioMistral-7B": ModelTemplate([('user', CONTENT)]),
+    "meta-llama/Meta-Llama-3-8B-Instruct": ModelTemplate([('user', "<s>[INST] <<SYS>>\nYou are a medical expert. Provide the best answer.\n<</SYS>>\n{content} [/INST]")]),
+    "swap-uniba/LLaMAntino-3-ANITA-8B-Inst-DPO-ITA": ModelTemplate([(
+        'user',
+        f"<|start_header_id|>system<|end_header_id|>\n{ANITA_SYSTEM_PROMPT}<|eot_id|>\n<|start_header_id|>user<|end_header_id|>\n{CONTENT}<|eot_id|>\n<|start_header_id|>assistant<|end_header_id|>\n"
+    )]),
+    "ContactDoctor/Bio-Medical-Llama-3-8B": ModelTemplate([('system', "You are an expert trained on healthcare and biomedical domain!"), ('user', CONTENT)]),
+    "google/gemma-2-9b-it": ModelTemplate([('user', CONTENT)]),
+    "Shaleen123/gemma2-9b-medical": ModelTemplate([('user', CONTENT)]),
+}
+
+DEFAULT_TEMPLATE = ModelTemplate([('user', CONTENT)])
+
+
+def register_template(model, template):
+    TEMPLATES[model] = template
+
+
+def question_text(sheet_header, question, answers):
+    return sheet_header + ROW_BODY.format(question=question, **answers)
+
+
+class PromptTemplate:
+    # Template di un modello risolto una volta per tokenizer: il chat template viene applicato a un segnaposto
+    # e diviso nelle parti fisse prima e dopo la domanda, così il prompt di una riga è una concatenazione di stringhe.
+
+    def __init__(self, model, tokenizer):
+        self.model_template = TEMPLATES.get(model, DEFAULT_TEMPLATE)
+        self.tokenizer = tokenizer
+        self.source = 'chat template del tokenizer'
+        if self.model_template.chat_template is not None:
+            self.chat_template = self.model_template.chat_template
+            self.source = 'template esplicito del modello'
+        else:
+            self.chat_template = None
+            try:
+                self._apply(self.model_template.build('x'))
+            except Exception as e:
+                # Tokenizer senza chat template, oppure template che rifiuta questi messaggi (es. ruoli non alternati)
+                print(f"Chat template non utilizzabile per {model} ({e}): uso il template esplicito.")
+                self.chat_template = FALLBACK_CHAT_TEMPLATE
+                self.source = 'template esplicito generico'
+
+        # Il template tratta la domanda come testo opaco solo se due segnaposto diversi danno le stesse parti fisse
+        self.head, self.tail = self._split('\x00DOMANDA\x00')
+        self.opaque = self.head is not None and (self.head, self.tail) == self._split('\x01QUESTION\x01')
+        self._sheets = {}
+
+    def _apply(self, messages):
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True, chat_template=self.chat_template)
+
+    def _split(self, placeholder):
+        rendered = self._apply(self.model_template.build(placeholder))
+        if rendered.count(placeholder) != 1:
+            return None, None
+        head, tail = rendered.split(placeholder)
+        return head, tail
+
+    def messages(self, content):
+        return self.model_template.build(content)
+
+    def render(self, messages):
+        return self._apply(messages)
+
+    def for_sheet(self, category):
+        if category not in self._sheets:
+            self._sheets[category] = SheetTemplate(self, category)
+        return self._sheets[category]
+
+
+class SheetTemplate:
+    # Parti fisse del prompt per un foglio: testo e token del prefisso comune (template, system prompt,
+    # preambolo e categoria) sono calcolati una volta; per ogni riga si tokenizza solo il resto.
+
+    def __init__(self, template, category):
+        self.template = template
+        self.header = SHEET_HEADER.format(category=category)
+        # Il prefisso si ferma prima dello spazio finale, che i tokenizer BPE uniscono alla parola successiva
+        self.prefix = (template.head + self.header).rstrip(' ') if template.opaque else None
+        self.prefix_ids = None
+        self.split_exact = None
+
+    def messages(self, question, answers):
+        return self.template.messages(question_text(self.header, question, answers))
+
+    def fill(self, question, answers, scoring='generate'):
+        # Messaggi (per l'output nel formato della pipeline) e prompt completo di una riga.
+        # In modalità logits il prompt prosegue con l'inizio della risposta JSON.
+        content = question_text(self.header, question, answers)
+        messages = self.template.messages(content)
+        if self.template.opaque:
+            prompt = self.template.head + content + self.template.tail
+        else:
+            prompt = self.template.render(messages)
+        if scoring == 'logits':
+            prompt += ANSWER_PREFIX
+        return messages, prompt
+
+    def _tokenize(self, text):
+        return self.template.tokenizer(text, add_special_tokens=False)['input_ids']
+
+    def encode(self, prompt):
+        # Token del prefisso in cache + token del resto. Si usa solo se, sul primo prompt del foglio,
+        # la tokenizzazione divisa coincide con quella del prompt intero (dipende dal tokenizer)
+        if self.prefix is None or not prompt.startswith(self.prefix):
+            return self._tokenize(prompt)
+        if self.prefix_ids is None:
+            self.prefix_ids = self._tokenize(self.prefix)
+        if self.split_exact is None:
+            full = self._tokenize(prompt)
+            self.split_exact = full == self.prefix_ids + self._tokenize(prompt[len(self.prefix):])
+            return full
+        if not self.split_exact:
+            return self._tokenize(prompt)
+        return self.prefix_ids + self._tokenize(prompt[len(self.prefix):])
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_template(model, tokenizer):
+    template = PromptTemplate(model, tokenizer)
+    print(f"Template del prompt per {model}: {template.source}" + ("" if template.opaque else " (resa completa per ogni riga)"))
+    return template
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = 'response_cache.sqlite'
+DEFAULT_MAX_MB = 1024
+
+
+def model_revision(text_gen_pipeline):
+    # Commit del checkpoint scaricato dall'Hub, se disponibile: un modello aggiornato non riusa risposte vecchie
+    config = text_gen_pipeline.model.config
+    return getattr(config, '_commit_hash', None) or getattr(config, 'name_or_path', None)
+
+
+def cache_key(model, revision, prompt, params):
+    payload = json.dumps({'model': model, 'revision': revision, 'prompt': prompt, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    # Cache su disco (SQLite) delle risposte del modello, indirizzata per contenuto:
+    # la chiave è l'hash di modello/revisione, prompt completo e parametri di decodifica.
+    # Quando supera max_mb elimina le voci usate meno di recente.
+    # Può essere usata da più thread dello stesso processo (lookup in preparazione, scrittura a valle).
+    # La dimensione totale è tenuta aggiornata a ogni scrittura; la somma sulla tabella si rifà solo quando
+    # la stima supera il limite (altri processi possono aver scritto nella stessa cache) e nel riepilogo.
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_mb=DEFAULT_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self._connection.commit()
+        self._total = self.total_bytes()
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        encoded = json.dumps(value)
+        with self._lock:
+            previous = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                (key, encoded, len(encoded), time.time())
+            )
+            self._total += len(encoded) - (previous[0] if previous else 0)
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+            self.evict()
+
+    def total_bytes(self):
+        with self._lock:
+            return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def evict(self):
+        if self._total <= self.max_bytes:
+            return
+        self._total = self.total_bytes()
+        excess = self._total - self.max_bytes
+        if excess <= 0:
+            return
+        freed = 0
+        keys = []
+        for key, size in self._connection.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+        self._connection.commit()
+        self._total -= freed
+        self.evicted += len(keys)
+
+    def report(self):
+        # Statistiche dall'ultimo riepilogo, cioè del foglio appena elaborato
+        with self._lock:
+            lookups = self.hits + self.misses
+            hit_rate = self.hits / lookups if lookups else 0.0
+            self._total = self.total_bytes()
+            print(f"Cache risposte {os.path.basename(self.path)}: {self.hits} hit, {self.misses} miss ({hit_rate:.1%}), "
+                  f"{self.evicted} voci eliminate, {self._total / (1024 * 1024):.1f} MB su disco")
+            self.hits = self.misses = self.evicted = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
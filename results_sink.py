@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+
+# Umask del processo, letta all'import (prima che partano i thread): os.umask si legge solo impostandola
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def creation_mode(mode=0o666):
+    # Permessi che avrebbe un file (0o666) o una cartella (0o777) creati normalmente: mkstemp e mkdtemp usano 0600/0700
+    return mode & ~UMASK
+
+
+class ResultSink:
+    # Interfaccia comune dei sink: write() per ogni risultato, finalize() a fine foglio.
+    # Un nuovo formato (es. Parquet) si aggiunge con una sottoclasse e register_sink().
+
+    def __init__(self, json_filename):
+        self.json_filename = json_filename
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def finalize(self, sort_key=None):
+        # sort_key: ordine dei record nel file finale (es. la posizione della riga nel foglio)
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # In caso di errore il giornale resta su disco, ma il file finale non viene scritto
+        self.close()
+        return False
+
+
+def journal_filename(json_filename):
+    return json_filename + 'l'
+
+
+def read_journal(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Ultima riga troncata da un crash: i record precedenti sono comunque validi
+                print(f"Attenzione: riga incompleta ignorata in {path}")
+    return records
+
+
+def atomic_write_json(path, data):
+    # Scrive su un file temporaneo nella stessa cartella e lo sostituisce in un colpo solo,
+    # così un crash non lascia mai un JSON a metà
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        # Si mantengono i permessi del file sostituito, altrimenti quelli di un file nuovo
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777 if os.path.exists(path) else creation_mode())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JsonlSink(ResultSink):
+    # Scrive i risultati in append su <json_filename>l (una riga JSON per risultato)
+    # e a fine foglio produce il JSON lista-di-dizionari usato dagli strumenti a valle
+
+    def __init__(self, json_filename, buffer_size=16, fsync_every=0, resume=False):
+        super().__init__(json_filename)
+        self.journal_filename = journal_filename(json_filename)
+        self.buffer_size = buffer_size
+        self.fsync_every = fsync_every
+        self._buffer = []
+        self._since_fsync = 0
+        self._file = open(self.journal_filename, 'a' if resume else 'w', encoding='utf-8')
+
+    def write(self, record):
+        self._buffer.append(json.dumps(record))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._since_fsync += len(self._buffer)
+            self._buffer = []
+        self._file.flush()
+        if self.fsync_every and self._since_fsync >= self.fsync_every:
+            os.fsync(self._file.fileno())
+            self._since_fsync = 0
+
+    def finalize(self, sort_key=None):
+        self.close()
+        records = read_journal(self.journal_filename)
+        if sort_key is not None:
+            records.sort(key=sort_key)
+        atomic_write_json(self.json_filename, records)
+        os.remove(self.journal_filename)
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+
+SINKS = {
+    'jsonl': JsonlSink,
+}
+
+
+def register_sink(name, sink_class):
+    SINKS[name] = sink_class
+
+
+def open_sink(json_filename, kind='jsonl', **options):
+    if kind not in SINKS:
+        raise ValueError(f"Sink sconosciuto '{kind}'. Disponibili: {', '.join(SINKS)}")
+    return SINKS[kind](json_filename, **options)
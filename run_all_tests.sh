@@ -82,12 +82,7 @@ categories=(
 # Percorso del file Excel
 excel_path="/content/DataExtraction.xlsx"
 
-# Loop attraverso tutti i modelli e categorie
-for model in "${models[@]}"; do
-    for category in "${categories[@]}"; do
-        command="python script_MC_new.py --excel_path \"$excel_path\" --category \"$category\" --model \"$model\""
-        echo "Esecuzione per modello: $model, categoria: $category"
-        echo "Comando: $command"
-        eval "$command"
-    done
-done
+# Un solo processo per tutta la sweep: ogni modello viene caricato una volta sola
+# e usato per tutte le categorie prima di passare al successivo
+echo "Esecuzione sweep su ${#models[@]} modelli e ${#categories[@]} categorie"
+python script_MC_sweep.py --excel_path "$excel_path" --models "${models[@]}" --categories "${categories[@]}"
@@ -0,0 +1,53 @@
+import hashlib
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+# Parametri di campionamento gestiti da RowSampler invece che da generate
+SAMPLING_KEYS = ['temperature', 'top_k', 'top_p']
+
+
+def row_seed(seed, prompt):
+    # Seed di una domanda: dipende solo dal seed della run e dal prompt, non dal batch né dalle risposte in cache
+    digest = hashlib.sha256(f"{seed}\0{prompt}".encode('utf-8')).hexdigest()
+    return int(digest[:16], 16)
+
+
+class SeededSampling:
+    # Campionamento riproducibile riga per riga: generate procede in modalità greedy e il token
+    # di ogni riga viene estratto da RowSampler con il generatore della domanda.
+
+    def __init__(self, seed, generation_kwargs):
+        self.seed = seed
+        self.warpers = LogitsProcessorList([
+            TemperatureLogitsWarper(generation_kwargs['temperature']),
+            TopKLogitsWarper(generation_kwargs['top_k']),
+            TopPLogitsWarper(generation_kwargs['top_p']),
+        ])
+
+    def generation_kwargs(self, generation_kwargs):
+        kwargs = {key: value for key, value in generation_kwargs.items() if key not in SAMPLING_KEYS}
+        kwargs['do_sample'] = False
+        return kwargs
+
+    def processor(self, prompts):
+        return RowSampler(self.warpers, [row_seed(self.seed, prompt) for prompt in prompts])
+
+
+class RowSampler(LogitsProcessor):
+    # Va applicato dopo gli altri processor (es. la grammatica della risposta): lascia a 0 solo il token estratto,
+    # che la decodifica greedy sceglie. I generatori sono su CPU, uno per riga del batch.
+
+    def __init__(self, warpers, seeds):
+        self.warpers = warpers
+        self.generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+
+    def __call__(self, input_ids, scores):
+        probabilities = torch.softmax(self.warpers(input_ids, scores).float(), dim=-1).cpu()
+        tokens = torch.cat([
+            torch.multinomial(row, 1, generator=generator)
+            for row, generator in zip(probabilities, self.generators)
+        ])
+        chosen = torch.full_like(scores, float('-inf'))
+        chosen[torch.arange(scores.shape[0], device=scores.device), tokens.to(scores.device)] = 0
+        return chosen
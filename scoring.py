@@ -0,0 +1,42 @@
+import functools
+
+import torch
+
+OPTION_LETTERS = ['A', 'B', 'C', 'D', 'E']
+
+# Inizio della risposta JSON richiesta dal prompt: dopo questo prefisso il token successivo è la lettera
+ANSWER_PREFIX = '{"answer": "'
+
+
+@functools.lru_cache(maxsize=None)
+def option_token_ids(tokenizer):
+    # Id del token di ciascuna lettera nel contesto reale, cioè subito dopo le virgolette del prefisso:
+    # codificata da sola la lettera può avere un token diverso (es. '▁A' nei tokenizer SentencePiece).
+    # Calcolati una volta per tokenizer: durante l'inferenza il tokenizer può essere in uso nello stadio di preparazione
+    prefix_ids = tokenizer.encode(ANSWER_PREFIX, add_special_tokens=False)
+    token_ids = []
+    for letter in OPTION_LETTERS:
+        ids = tokenizer.encode(ANSWER_PREFIX + letter, add_special_tokens=False)
+        if ids[:len(prefix_ids)] != prefix_ids or len(ids) == len(prefix_ids):
+            raise ValueError(f"La lettera '{letter}' si unisce ai token del prefisso della risposta per questo tokenizer.")
+        if len(ids) > len(prefix_ids) + 1:
+            print(f"Attenzione: la lettera '{letter}' corrisponde a {len(ids) - len(prefix_ids)} token, uso il primo.")
+        token_ids.append(ids[len(prefix_ids)])
+    if len(set(token_ids)) != len(token_ids):
+        raise ValueError("Le lettere delle opzioni non hanno token distinti per questo tokenizer.")
+    return token_ids
+
+
+@torch.inference_mode()
+def score_encoded(text_gen_pipeline, inputs):
+    # Un solo forward pass su prompt già tokenizzati (paddati a sinistra): la distribuzione sulle cinque lettere
+    # viene dai logit dell'ultimo token, l'unico per cui si calcola la testa del modello (logits_to_keep=1)
+    model = text_gen_pipeline.model
+    logits = model(**inputs.to(model.device), logits_to_keep=1).logits[:, -1, :]
+    option_logits = logits[:, option_token_ids(text_gen_pipeline.tokenizer)].float()
+    probabilities = torch.softmax(option_logits, dim=-1).tolist()
+    return [dict(zip(OPTION_LETTERS, row)) for row in probabilities]
+
+
+def best_option(probabilities):
+    return max(probabilities, key=probabilities.get)
@@ -0,0 +1,39 @@
+import argparse
+import os
+
+import pandas as pd
+
+from analytics import ResultsStore, QUERIES, DEFAULT_RESULTS_STORE, filter_results
+
+
+def run_analytics(results_dirs, queries, store=DEFAULT_RESULTS_STORE, models=None, categories=None, bins=5, csv_dir=None):
+    results_store = ResultsStore(store)
+    results_store.update(results_dirs)
+    df = filter_results(results_store.load(), models, categories)
+    print(f"{len(df)} risultati, {df['Model'].nunique()} modelli, {df['Category'].nunique()} categorie")
+    if df.empty:
+        return
+
+    if csv_dir:
+        os.makedirs(csv_dir, exist_ok=True)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        for query in queries:
+            table = QUERIES[query](df, bins) if query == 'difficulty' else QUERIES[query](df)
+            print(f"\n== {query} ==")
+            print(table)
+            if csv_dir:
+                table.to_csv(os.path.join(csv_dir, f"{query}.csv"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Statistiche aggregate sui file di risultati *_MC.json, aggiornate in modo incrementale.")
+    parser.add_argument('--results_dirs', nargs='+', default=['.'], help="Cartelle in cui cercare (ricorsivamente) i file *_MC.json.")
+    parser.add_argument('--query', nargs='+', choices=list(QUERIES), default=list(QUERIES), help="Statistiche da calcolare.")
+    parser.add_argument('--store', default=DEFAULT_RESULTS_STORE, help="Cartella dell'archivio colonnare dei risultati.")
+    parser.add_argument('--models', nargs='+', default=None, help="Limita ai modelli indicati (nome completo o ultima parte).")
+    parser.add_argument('--categories', nargs='+', default=None, help="Limita alle categorie indicate.")
+    parser.add_argument('--bins', type=int, default=5, help="Numero di fasce di difficoltà per la query difficulty.")
+    parser.add_argument('--csv_dir', default=None, help="Se indicata, salva ogni tabella in <csv_dir>/<query>.csv.")
+
+    args = parser.parse_args()
+    run_analytics(args.results_dirs, args.query, args.store, args.models, args.categories, args.bins, args.csv_dir)
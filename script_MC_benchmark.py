@@ -0,0 +1,218 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import string
+import subprocess
+import tempfile
+import time
+
+import pandas as pd
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from script_MC_new import process_sheet, output_filename, add_processing_arguments
+from ingestion import load_workbook
+from model_store import load_pipeline, peak_rss_mb, QUANTIZATION_CONFIGS
+from profiling import PROFILE
+
+DEFAULT_BENCHMARK_DIR = '.benchmark'
+DEFAULT_OUTPUT = os.path.join(DEFAULT_BENCHMARK_DIR, 'results.jsonl')
+
+# Parole per domande e risposte sintetiche: contano la lunghezza e la distribuzione dei prompt, non il senso
+WORDS = [
+    'paziente', 'terapia', 'diagnosi', 'sintomo', 'farmaco', 'dose', 'infezione', 'cronica', 'acuta', 'esame',
+    'sangue', 'cuore', 'polmone', 'rene', 'fegato', 'cervello', 'dolore', 'febbre', 'pressione', 'glicemia',
+    'anni', 'donna', 'uomo', 'bambino', 'anziano', 'ricovero', 'intervento', 'chirurgico', 'trattamento', 'rischio',
+    'prima', 'scelta', 'indicato', 'controindicato', 'frequente', 'raro', 'segno', 'clinico', 'quadro', 'storia',
+]
+
+TINY_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}</s>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+
+# Stadi riportati nei risultati, nell'ordine in cui avvengono
+STAGES = ['excel_load', 'excel_load_cached', 'prompt', 'tokenize', 'generation', 'prefill', 'decode', 'parse', 'write']
+
+
+def synthetic_workbook(path, sheets, rows, seed=0):
+    # Stesse colonne di DataExtraction.xlsx, contenuto casuale ma riproducibile
+    rng = random.Random(seed)
+    with pd.ExcelWriter(path) as writer:
+        for sheet in range(sheets):
+            records = []
+            for _ in range(rows):
+                options = [' '.join(rng.choices(WORDS, k=rng.randint(2, 8))) + f" {rng.randint(0, 999)}" for _ in range(5)]
+                records.append({
+                    'Category': f"Sintetico {sheet + 1}",
+                    'Question': ' '.join(rng.choices(WORDS, k=rng.randint(10, 40))) + '?',
+                    'AnswerA': options[0],
+                    'AnswerB': options[1],
+                    'AnswerC': options[2],
+                    'AnswerD': options[3],
+                    'AnswerE': options[4],
+                    'Correct Answer': rng.choice(options),
+                    'Percentage Correct': round(rng.uniform(0.2, 0.95), 2),
+                })
+            pd.DataFrame(records).to_excel(writer, sheet_name=f"Sintetico {sheet + 1}", index=False)
+
+
+def tiny_model(path, hidden_size=64, layers=2, seed=0):
+    # Llama inizializzato a caso con un tokenizer a caratteri: si crea in locale, senza scaricare nulla
+    if os.path.exists(os.path.join(path, 'config.json')):
+        return path
+    vocab = {'<pad>': 0, '<s>': 1, '</s>': 2, '<unk>': 3}
+    for char in string.printable + 'àèéìòùÀÈÉÌÒÙ':
+        vocab.setdefault(char, len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.Split('', 'isolated')
+    backend.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token='<s>', eos_token='</s>', unk_token='<unk>', pad_token='<pad>')
+    tokenizer.chat_template = TINY_CHAT_TEMPLATE
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(vocab), hidden_size=hidden_size, intermediate_size=hidden_size * 2, num_hidden_layers=layers,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=4096, pad_token_id=0, bos_token_id=1, eos_token_id=2
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    print(f"Creato il modello di prova {path}")
+    return path
+
+
+def io_counters():
+    # Byte letti e scritti dal processo (tutti i thread) secondo /proc: disponibile solo su Linux
+    try:
+        with open('/proc/self/io', 'r') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else None
+
+
+def compare_with_previous(output, record):
+    # Confronto con l'ultima run con la stessa configurazione, per individuare regressioni
+    if not os.path.exists(output):
+        return
+    previous = None
+    with open(output, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get('config') == record['config']:
+                previous = entry
+    if previous is None:
+        return
+    print(f"Confronto con la run del {previous['timestamp']} (commit {previous.get('commit')}):")
+    for key in ['questions_per_second', 'prefill_tokens_per_second', 'decode_tokens_per_second', 'peak_rss_mb']:
+        old, new = previous['metrics'].get(key), record['metrics'].get(key)
+        if old and new is not None:
+            print(f"   {key}: {old:.2f} -> {new:.2f} ({(new - old) / old:+.1%})")
+
+
+def run_benchmark(model=None, sheets=2, rows=16, hidden_size=64, layers=2, quantization='none', data_seed=0,
+                  output=DEFAULT_OUTPUT, workdir=DEFAULT_BENCHMARK_DIR, **options):
+    os.makedirs(workdir, exist_ok=True)
+    model_path = model or tiny_model(os.path.join(workdir, f"tiny-llama-{hidden_size}x{layers}"), hidden_size, layers, data_seed)
+
+    with tempfile.TemporaryDirectory(dir=workdir) as run_dir:
+        excel_path = os.path.join(run_dir, 'synthetic.xlsx')
+        synthetic_workbook(excel_path, sheets, rows, data_seed)
+
+        PROFILE.reset()
+        io_start = io_counters()
+        start = time.perf_counter()
+        text_gen_pipeline = load_pipeline(model_path, quantization, use_store=False)
+        load_seconds = time.perf_counter() - start
+
+        # Prima lettura: conversione dell'Excel nella cache colonnare; seconda: lettura dalla cache
+        with PROFILE.stage('excel_load'):
+            frames = load_workbook(excel_path, cache_dir=os.path.join(run_dir, 'workbook_cache'))
+        with PROFILE.stage('excel_load_cached'):
+            load_workbook(excel_path, cache_dir=os.path.join(run_dir, 'workbook_cache'))
+
+        start = time.perf_counter()
+        for sheet_name, df in frames.items():
+            process_sheet(df, sheet_name, model_path, os.path.join(run_dir, output_filename(sheet_name, model_path)), text_gen_pipeline, **options)
+        process_seconds = time.perf_counter() - start
+        io_end = io_counters()
+
+    seconds, counters = dict(PROFILE.seconds), dict(PROFILE.counters)
+    PROFILE.reset(enabled=False)
+    metrics = {
+        'questions': counters.get('questions', 0),
+        'questions_per_second': rate(counters.get('questions', 0), process_seconds),
+        'prefill_tokens': counters.get('prefill_tokens', 0),
+        'decode_tokens': counters.get('decode_tokens', 0),
+        'prefill_tokens_per_second': rate(counters.get('prefill_tokens', 0), seconds.get('prefill', 0)),
+        'decode_tokens_per_second': rate(counters.get('decode_tokens', 0), seconds.get('decode', 0)),
+        'model_load_seconds': load_seconds,
+        'process_seconds': process_seconds,
+        'stage_seconds': {stage: seconds.get(stage, 0.0) for stage in STAGES},
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_gpu_mb': torch.cuda.max_memory_allocated() / (1024 * 1024) if torch.cuda.is_available() else None,
+        'io_read_bytes': io_end[0] - io_start[0] if io_start and io_end else None,
+        'io_write_bytes': io_end[1] - io_start[1] if io_start and io_end else None,
+    }
+    record = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'config': {
+            'model': model or f"tiny-llama-{hidden_size}x{layers}", 'sheets': sheets, 'rows': rows,
+            'quantization': quantization, 'data_seed': data_seed, 'device': str(text_gen_pipeline.model.device),
+            'options': {key: options[key] for key in sorted(options)},
+        },
+        'metrics': metrics,
+    }
+
+    print(f"{metrics['questions']} domande in {process_seconds:.2f}s: {metrics['questions_per_second']:.2f} domande/s")
+    print(f"Prefill: {metrics['prefill_tokens']} token, {metrics['prefill_tokens_per_second'] or 0:.0f} token/s; "
+          f"decodifica: {metrics['decode_tokens']} token, {metrics['decode_tokens_per_second'] or 0:.0f} token/s")
+    print("Tempo per stadio: " + ', '.join(f"{stage} {metrics['stage_seconds'][stage]:.3f}s" for stage in STAGES))
+    print(f"RSS di picco {metrics['peak_rss_mb']:.0f} MB, I/O {metrics['io_read_bytes']} byte letti, {metrics['io_write_bytes']} byte scritti")
+    compare_with_previous(output, record)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print(f"Risultati aggiunti a {output}")
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Misura le prestazioni di process_sheet su un file Excel sintetico e un piccolo modello locale.")
+    parser.add_argument('--model', default=None, help="Modello da misurare; senza questa opzione si usa un piccolo Llama inizializzato a caso.")
+    parser.add_argument('--sheets', type=int, default=2, help="Fogli del file Excel sintetico.")
+    parser.add_argument('--rows', type=int, default=16, help="Domande per foglio.")
+    parser.add_argument('--hidden_size', type=int, default=64, help="Dimensione nascosta del modello di prova.")
+    parser.add_argument('--layers', type=int, default=2, help="Layer del modello di prova.")
+    parser.add_argument('--quantization', choices=list(QUANTIZATION_CONFIGS), default='none', help="Quantizzazione del modello misurato.")
+    parser.add_argument('--data_seed', type=int, default=0, help="Seed del file Excel sintetico e dei pesi del modello di prova.")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="File JSONL a cui aggiungere i risultati di ogni run (default nella cartella del benchmark, ignorata da git).")
+    parser.add_argument('--workdir', default=DEFAULT_BENCHMARK_DIR, help="Cartella per il modello di prova e i file temporanei.")
+    add_processing_arguments(parser)
+
+    args = vars(parser.parse_args())
+    # Il benchmark misura il calcolo: niente cache delle risposte, e il file Excel sintetico ha la sua cache temporanea
+    for key in ['workbook_cache', 'no_cache', 'cache_path', 'cache_max_mb']:
+        args.pop(key)
+    run_benchmark(**args)
@@ -1,12 +1,15 @@
 import pandas as pd
 import argparse
-from transformers import pipeline
 from tqdm import tqdm
-import torch
 import json
 import os
 import re
 
+from results_sink import open_sink
+from ingestion import load_workbook
+from prompt_templates import resolve_template
+from model_store import load_pipeline
+
 # Variabile globale per tenere traccia dello stato di inizializzazione del modello
 model_initialized = False
 text_gen_pipeline = None
@@ -16,94 +19,82 @@ def clean_text(text):
         return ''
     return str(text).strip().lower().replace('\n', ' ').replace(";", "")
 
-def process_sheet(df, category, model, json_filename, text_gen_pipeline):
+def process_sheet(df, category, model, json_filename, text_gen_pipeline, sink='jsonl', fsync_every=0):
     # Verifica che tutte le colonne richieste esistano
     required_columns = ['Category', 'Question', 'AnswerA', 'AnswerB', 'AnswerC', 'AnswerD', 'AnswerE', 'Correct Answer', 'Percentage Correct']
     if not all(col in df.columns for col in required_columns):
         print(f"Error: Una o più colonne richieste mancano nel foglio '{category}'.")
         return
 
-    # Assicurati che il file JSON esista
-    if not os.path.exists(json_filename):
-        with open(json_filename, 'w') as f:
-            json.dump([], f)  # Inizializza con una lista vuota
-
-    for i, row in tqdm(df.iterrows(), total=len(df)):
-        question = row['Question']
-        answers = {
-            'A': clean_text(row['AnswerA']),
-            'B': clean_text(row['AnswerB']),
-            'C': clean_text(row['AnswerC']),
-            'D': clean_text(row['AnswerD']),
-            'E': clean_text(row['AnswerE'])
-        }
-
-        answer2key = {v: k for k, v in answers.items()}
-
-        correct_answer_text = clean_text(row['Correct Answer'])
-        try:
-            correct_answer_key = answer2key[correct_answer_text]
-        except:
-            print("ERROR!")
-            print("   Question: ", question)
-            print("   Answers: ", answers)
-            print("   Correct answer: ", correct_answer_text)
-            continue
-        percentage_correct = row['Percentage Correct']
-
-        content = f"""Di seguito è riportata una domanda attinente al dominio medico. Sei un esperto di domande a risposta multipla nell'ambito clinico. Scegli la risposta corretta tra le cinque opzioni disponibili. \n
-            Categoria Medica: {category}\n
-            Domanda Medica: {question}\n
-            A: {answers['A']}\n
-            B: {answers['B']}\n
-            C: {answers['C']}\n
-            D: {answers['D']}\n
-            E: {answers['E']}\n
-            Istruzione:
-            Restituisci il tuo risultato in formato JSON contenente un campo 'answer' che indica la lettera corrispondente alla risposta corretta (A, B, C, D oppure E). Il campo non può mai essere vuoto."""
-
-  
-        messages = [{"role": "user", "content": content}]
-        try:
-            response = text_gen_pipeline(
-                          messages,
-                          max_new_tokens=128,
-                          do_sample=True,
-                          temperature=0.7,
-                          top_k=50,
-                          top_p=0.95
-                      )
-            generated_text = response[0]['generated_text'][-1]['content'] 
-            response_dict = json.loads(generated_text)
-            model_answer = response_dict['answer']
-
-            is_correct = model_answer == correct_answer_key
-
-            result = {
-                'Category': category,
-                'Task': 'Multiple Choice',
-                'Models': model,
-                'Question': question,
-                'Answer A': answers['A'],
-                'Answer B': answers['B'],
-                'Answer C': answers['C'],
-                'Answer D': answers['D'],
-                'Answer E': answers['E'],
-                'Correct Answer': correct_answer_key,
-                'Model Answer': model_answer,
-                'Percentage Correct': percentage_correct,
-                'Is Correct': is_correct,
+    # Template del modello risolto una volta per foglio: per ogni riga si compilano solo domanda e risposte
+    template = resolve_template(model, text_gen_pipeline.tokenizer)
+    if template.chat_template is not None:
+        # Il tokenizer non ha un chat template utilizzabile: la pipeline usa quello esplicito
+        text_gen_pipeline.tokenizer.chat_template = template.chat_template
+    sheet_template = template.for_sheet(category)
+
+    with open_sink(json_filename, sink, fsync_every=fsync_every) as results:
+        for i, row in tqdm(df.iterrows(), total=len(df)):
+            question = row['Question']
+            answers = {
+                'A': clean_text(row['AnswerA']),
+                'B': clean_text(row['AnswerB']),
+                'C': clean_text(row['AnswerC']),
+                'D': clean_text(row['AnswerD']),
+                'E': clean_text(row['AnswerE'])
             }
 
-            # Aggiungi il risultato al file JSON
-            with open(json_filename, 'r+') as f:
-                data = json.load(f)
-                data.append(result)
-                f.seek(0)
-                json.dump(data, f, indent=4)
-
-        except Exception as e:
-            print(f"Error in model request: {e}")
+            answer2key = {v: k for k, v in answers.items()}
+
+            correct_answer_text = clean_text(row['Correct Answer'])
+            try:
+                correct_answer_key = answer2key[correct_answer_text]
+            except:
+                print("ERROR!")
+                print("   Question: ", question)
+                print("   Answers: ", answers)
+                print("   Correct answer: ", correct_answer_text)
+                continue
+            percentage_correct = row['Percentage Correct']
+
+            messages = sheet_template.messages(question, answers)
+            try:
+                response = text_gen_pipeline(
+                              messages,
+                              max_new_tokens=128,
+                              do_sample=True,
+                              temperature=0.7,
+                              top_k=50,
+                              top_p=0.95
+                          )
+                generated_text = response[0]['generated_text'][-1]['content'] 
+                response_dict = json.loads(generated_text)
+                model_answer = response_dict['answer']
+
+                is_correct = model_answer == correct_answer_key
+
+                result = {
+                    'Category': category,
+                    'Task': 'Multiple Choice',
+                    'Models': model,
+                    'Question': question,
+                    'Answer A': answers['A'],
+                    'Answer B': answers['B'],
+                    'Answer C': answers['C'],
+                    'Answer D': answers['D'],
+                    'Answer E': answers['E'],
+                    'Correct Answer': correct_answer_key,
+                    'Model Answer': model_answer,
+                    'Percentage Correct': percentage_correct,
+                    'Is Correct': is_correct,
+                }
+
+                results.write(result)
+
+            except Exception as e:
+                print(f"Error in model request: {e}")
+
+        results.finalize()
 
     print(f'Updated results for sheet "{category}" in {json_filename}')
 
@@ -111,13 +102,8 @@ def initialize_model(model):
     global model_initialized, text_gen_pipeline
     if not model_initialized:
         print("Initializing the model...")
-        text_gen_pipeline = pipeline("text-generation",
-                                     model=model,
-                                     model_kwargs={
-                                        "torch_dtype": torch.float16,
-                                        "quantization_config": {"load_in_4bit": True}
-                                      },
-                                    )
+        # Al primo caricamento il modello quantizzato viene salvato in .model_store e poi ricaricato da lì
+        text_gen_pipeline = load_pipeline(model)
         model_initialized = True
         print("Model initialized.")
 
@@ -126,7 +112,7 @@ def main(excel_path, category, model):
 
     if category.lower() == "all":
         # Carica tutti i fogli
-        sheets = pd.read_excel(excel_path, sheet_name=None)
+        sheets = load_workbook(excel_path)
         for sheet_name, df in sheets.items():
             json_filename = f"{sheet_name.replace(' ', '-').replace(',','')}_{model.split('/')[-1]}_MC.json"
             if os.path.exists(json_filename):
@@ -135,7 +121,7 @@ def main(excel_path, category, model):
                 print(f"Elaborazione foglio '{sheet_name}'...")
                 process_sheet(df, sheet_name, model, json_filename, text_gen_pipeline)
     else:
-        df = pd.read_excel(excel_path, sheet_name=category)
+        df = load_workbook(excel_path, [category])[category]
         json_filename = f"{category.replace(' ', '-').replace(',','')}_{model.split('/')[-1]}_MC.json"
         if os.path.exists(json_filename):
             print(f"Saltato foglio '{category}' perché il file di output '{json_filename}' esiste già.")
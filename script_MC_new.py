@@ -1,15 +1,33 @@
 import pandas as pd
 import argparse
-from transformers import pipeline
+from transformers import StoppingCriteriaList, LogitsProcessorList
 from tqdm import tqdm
 import torch
 import json
 import os
 import re
+import gc
+import threading
+import time
+
+from results_sink import open_sink, SINKS
+from scoring import score_encoded, best_option, option_token_ids
+from constrained_decoding import AnswerGrammar
+from sampling import SeededSampling
+from prefix_cache import PrefixCache
+from prompt_templates import resolve_template
+from model_store import load_pipeline, QUANTIZATION_CONFIGS, DEFAULT_MODEL_STORE
+from ingestion import normalize_sheet, load_workbook, DEFAULT_WORKBOOK_CACHE
+from checkpoint import CompletionIndex, question_id, record_question_id, index_filename, load_previous_results
+from response_cache import ResponseCache, cache_key, model_revision, DEFAULT_CACHE_PATH, DEFAULT_MAX_MB
+from staged import StagedLoop, DEFAULT_QUEUE_DEPTH
+from profiling import PROFILE
+from batching import parse_batch_size, resolve_batch_limits, prepare_tokenizer_for_batching, pad_token_ids, schedule_by_length, padding_efficiency, iter_batches, auto_token_budget, AdaptiveBatcher
 
 # Variabile globale per tenere traccia dello stato di inizializzazione del modello
 model_initialized = False
 text_gen_pipeline = None
+loaded_model = None
 
 def clean_text(text):
     if pd.isna(text):
@@ -17,179 +35,450 @@ def clean_text(text):
     return str(text).strip().lower().replace('\n', ' ').replace(";", "")
 
 
-def process_sheet(df, category, model, json_filename, text_gen_pipeline):
+GENERATION_KWARGS = {
+    'max_new_tokens': 128,
+    'do_sample': True,
+    'temperature': 0.7,
+    'top_k': 50,
+    'top_p': 0.95
+}
+
+GREEDY_GENERATION_KWARGS = {
+    'max_new_tokens': 128,
+    'do_sample': False
+}
+
+# generate: il modello scrive il JSON con la risposta; logits: si sceglie la lettera più probabile con un solo forward pass
+SCORING_MODES = ['generate', 'logits']
+
+
+def prepare_row(row):
+    # Le risposte normalizzate e la lettera corretta sono già calcolate in modo vettoriale da normalize_sheet
+    question = row['Question']
+    answers = {key: row[f'Answer{key} Clean'] for key in ['A', 'B', 'C', 'D', 'E']}
+
+    correct_answer_key = row['Correct Key']
+    if not isinstance(correct_answer_key, str):
+        print("ERROR!")
+        print("   Question: ", question)
+        print("   Answers: ", answers)
+        print("   Correct answer: ", row['Correct Answer Clean'])
+        return None
+
+    return {
+        'question': question,
+        'answers': answers,
+        'correct_answer_key': correct_answer_key,
+        'percentage_correct': row['Percentage Correct']
+    }
+
+
+def parse_response(response):
+    generated_text = response[0]['generated_text'][-1]['content']
+    response_dict = json.loads(generated_text)
+    return response_dict['answer']
+
+
+def make_result(item, category, model, model_answer):
+    answers = item['answers']
+    return {
+        'Category': category,
+        'Task': 'Multiple Choice',
+        'Models': model,
+        'Question': item['question'],
+        'Answer A': answers['A'],
+        'Answer B': answers['B'],
+        'Answer C': answers['C'],
+        'Answer D': answers['D'],
+        'Answer E': answers['E'],
+        'Correct Answer': item['correct_answer_key'],
+        'Model Answer': model_answer,
+        'Percentage Correct': item['percentage_correct'],
+        'Is Correct': model_answer == item['correct_answer_key'],
+        'Question ID': item['question_id'],
+    }
+
+
+def constraint_kwargs(grammar):
+    return grammar.generation_kwargs() if grammar is not None else {}
+
+
+def decoding_kwargs(generation_kwargs, grammar, sampling, batch):
+    # Il campionamento con seed per riga va dopo la grammatica: estrae il token tra quelli ammessi
+    kwargs = {**generation_kwargs, **constraint_kwargs(grammar)}
+    if sampling is not None:
+        processors = list(kwargs.get('logits_processor', [])) + [sampling.processor([item['prompt'] for item in batch])]
+        kwargs['logits_processor'] = LogitsProcessorList(processors)
+    return kwargs
+
+
+@torch.inference_mode()
+def generate_encoded(text_gen_pipeline, batch_messages, inputs, generation_kwargs, tokenizer_lock):
+    # Generazione su prompt già tokenizzati dallo stadio di preparazione, con output nel formato della pipeline
+    model = text_gen_pipeline.model
+    inputs = inputs.to(model.device)
+    timer = PROFILE.first_token_timer()
+    if timer is not None:
+        generation_kwargs = {**generation_kwargs, 'stopping_criteria': StoppingCriteriaList(list(generation_kwargs.get('stopping_criteria', [])) + [timer])}
+    start = time.perf_counter()
+    output = model.generate(**inputs, **generation_kwargs)
+    generated = output[:, inputs['input_ids'].shape[1]:]
+    if timer is not None and timer.first_token is not None:
+        # Prefill fino al primo token, decodifica per il resto; il padding dopo l'EOS non conta
+        PROFILE.add_time('prefill', timer.first_token - start)
+        PROFILE.add_time('decode', time.perf_counter() - timer.first_token)
+        PROFILE.count('prefill_tokens', int(inputs['attention_mask'].sum()))
+        PROFILE.count('decode_tokens', max(0, int((generated != text_gen_pipeline.tokenizer.pad_token_id).sum()) - generated.shape[0]))
+    with tokenizer_lock:
+        texts = text_gen_pipeline.tokenizer.batch_decode(generated, skip_special_tokens=True)
+    return [
+        [{'generated_text': messages + [{'role': 'assistant', 'content': text}]}]
+        for messages, text in zip(batch_messages, texts)
+    ]
+
+
+def run_batch(text_gen_pipeline, batch, batch_indices, scoring, generation_kwargs, grammar=None, prefix=None, inputs=None, tokenizer_lock=None, sampling=None):
+    # Un output per riga del batch: distribuzione sulle lettere (logits) oppure output della pipeline (generate).
+    # Senza prefisso condiviso i prompt arrivano già tokenizzati in inputs.
+    batch_messages = [item['messages'] for item in batch]
+    if scoring == 'logits':
+        if prefix is not None:
+            return prefix.score_options(batch_indices)
+        # Solo prefill: un forward pass sul prompt
+        with PROFILE.stage('prefill'):
+            probabilities = score_encoded(text_gen_pipeline, inputs)
+        PROFILE.count('prefill_tokens', int(inputs['attention_mask'].sum()))
+        return probabilities
+    if prefix is not None:
+        return [
+            prefix.generate(index, item['messages'], decoding_kwargs(generation_kwargs, grammar, sampling, [item]))
+            for index, item in zip(batch_indices, batch)
+        ]
+    return generate_encoded(text_gen_pipeline, batch_messages, inputs, decoding_kwargs(generation_kwargs, grammar, sampling, batch), tokenizer_lock)
+
+
+def cache_params(scoring, constrained, generation_kwargs, seed):
+    # Parametri che influenzano la risposta: le run campionate sono distinte per seed (seed per domanda)
+    if scoring == 'logits':
+        return {'scoring': scoring}
+    params = {'scoring': scoring, 'constrained': constrained, 'generation': generation_kwargs}
+    if generation_kwargs.get('do_sample'):
+        params['seed'] = seed
+        params['sampling'] = 'per_row'
+    return params
+
+
+def cached_response(item, value, scoring):
+    if scoring == 'logits':
+        return value
+    return [{'generated_text': item['messages'] + [{'role': 'assistant', 'content': value}]}]
+
+
+def process_sheet(df, category, model, json_filename, text_gen_pipeline, sink='jsonl', fsync_every=0, batch_size=1, greedy=False, max_batch_tokens=None, scoring='generate', constrained=False, prefix_cache=False, response_cache=None, seed=None, retry_failed=False, queue_depth=DEFAULT_QUEUE_DEPTH, shared_answers=None):
     required_columns = ['Category', 'Question', 'AnswerA', 'AnswerB', 'AnswerC', 'AnswerD', 'AnswerE', 'Correct Answer', 'Percentage Correct']
     if not all(col in df.columns for col in required_columns):
         print(f"Error: Una o più colonne richieste mancano nel foglio '{category}'.")
         return
 
-    if not os.path.exists(json_filename):
-        with open(json_filename, 'w') as f:
-            json.dump([], f)  # Inizializza con una lista vuota
-
-    for i, row in tqdm(df.iterrows(), total=len(df)):
-        question = row['Question']
-        answers = {
-            'A': clean_text(row['AnswerA']),
-            'B': clean_text(row['AnswerB']),
-            'C': clean_text(row['AnswerC']),
-            'D': clean_text(row['AnswerD']),
-            'E': clean_text(row['AnswerE'])
-        }
-
-        answer2key = {v: k for k, v in answers.items()}
-
-        correct_answer_text = clean_text(row['Correct Answer'])
-        try:
-            correct_answer_key = answer2key[correct_answer_text]
-        except:
-            print("ERROR!")
-            print("   Question: ", question)
-            print("   Answers: ", answers)
-            print("   Correct answer: ", correct_answer_text)
-            continue
-        percentage_correct = row['Percentage Correct']
-
-        content = f"""Di seguito è riportata una domanda attinente al dominio medico. Sei un esperto di domande a risposta multipla nell'ambito clinico. Scegli la risposta corretta tra le cinque opzioni disponibili. \n
-            Categoria Medica: {category}\n
-            Domanda Medica: {question}\n
-            A: {answers['A']}\n
-            B: {answers['B']}\n
-            C: {answers['C']}\n
-            D: {answers['D']}\n
-            E: {answers['E']}\n
-            Istruzione:
-            Restituisci il tuo risultato in formato JSON contenente un campo 'answer' che indica la lettera corrispondente alla risposta corretta (A, B, C, D oppure E). Il campo non può mai essere vuoto."""
-        
-        if model == "mistralai/Mistral-7B-Instruct-v0.1":
-            formatted_content = f"<s>[INST] {content} [/INST]</s>"
-            messages = [{"role": "user", "content": formatted_content}]
-            max_length = 2048
-        elif model == "mii-community/zefiro-7b-base-ITA":
-            sys_prompt = "Sei un assistente disponibile, rispettoso e onesto. " \
-                         "Rispondi sempre nel modo piu' utile possibile, pur essendo sicuro. " \
-                         "Le risposte non devono includere contenuti dannosi, non etici, razzisti, sessisti, tossici, pericolosi o illegali. " \
-                         "Assicurati che le tue risposte siano socialmente imparziali e positive. " \
-                         "Se una domanda non ha senso o non e' coerente con i fatti, spiegane il motivo invece di rispondere in modo non corretto. " \
-                         "Se non conosci la risposta a una domanda, non condividere informazioni false."
-            user_prompt = content 
-            messages = [
-                {'role': 'assistant', 'content': sys_prompt},
-                {'role': 'user', 'content': user_prompt}
-            ]
-            max_length = 2048
-        elif model == "BioMistral/BioMistral-7B":
-            messages = [{"role": "user", "content": content}]
-            max_length = 2048
-        elif model == "meta-llama/Meta-Llama-3-8B-Instruct":
-            formatted_content = f"""<s>[INST] <<SYS>>\nYou are a medical expert. Provide the best answer.\n<</SYS>>\n{content} [/INST]"""
-            messages = [{"role": "user", "content": formatted_content}]
-            max_length = 2048
-        elif model == "swap-uniba/LLaMAntino-3-ANITA-8B-Inst-DPO-ITA":
-            sys_prompt = "Tu sei un assistente medico esperto. Fornisci la migliore risposta possibile."
-            user_prompt = content
-            formatted_content = f"<|start_header_id|>system<|end_header_id|>\n{sys_prompt}<|eot_id|>\n<|start_header_id|>user<|end_header_id|>\n{user_prompt}<|eot_id|>\n<|start_header_id|>assistant<|end_header_id|>\n"
-            messages = [{"role": "user", "content": formatted_content}]
-            max_length = 2048
-        elif model == "ContactDoctor/Bio-Medical-Llama-3-8B":
-            sys_prompt = "You are an expert trained on healthcare and biomedical domain!"
-            messages = [
-                {"role": "system", "content": sys_prompt},
-                {"role": "user", "content": content}
-            ]
-            max_length = 2048
-        elif model == "google/gemma-2-9b-it":
-            messages = [{"role": "user", "content": content}]
-            max_length = 2048
-        elif model == "Shaleen123/gemma2-9b-medical":
-            messages = [{"role": "user", "content": content}]
-            max_length = 2048
-        else:
-            messages = [{"role": "user", "content": content}]
-            max_length = 4096
-
-        try:
-            response = text_gen_pipeline(
-                messages,
-                max_new_tokens=128,
-                do_sample=True,
-                temperature=0.7,
-                top_k=50,
-                top_p=0.95
-            )
-            generated_text = response[0]['generated_text'][-1]['content'] 
-            response_dict = json.loads(generated_text)
-            model_answer = response_dict['answer']
-
-            is_correct = model_answer == correct_answer_key
-
-            result = {
-                'Category': category,
-                'Task': 'Multiple Choice',
-                'Models': model,
-                'Question': question,
-                'Answer A': answers['A'],
-                'Answer B': answers['B'],
-                'Answer C': answers['C'],
-                'Answer D': answers['D'],
-                'Answer E': answers['E'],
-                'Correct Answer': correct_answer_key,
-                'Model Answer': model_answer,
-                'Percentage Correct': percentage_correct,
-                'Is Correct': is_correct,
-            }
-
-            with open(json_filename, 'r+') as f:
-                data = json.load(f)
-                data.append(result)
-                f.seek(0)
-                json.dump(data, f, indent=4)
-
-        except Exception as e:
-            print(f"Error in model request: {e}")
+    if 'Correct Key' not in df.columns:
+        df = normalize_sheet(df)
 
+    # Template del modello risolto una volta: per ogni riga si compilano solo domanda e risposte
+    sheet_template = resolve_template(model, text_gen_pipeline.tokenizer).for_sheet(category)
+    items = []
+    with PROFILE.stage('prompt'):
+        for row in df.to_dict('records'):
+            item = prepare_row(row)
+            if item is None:
+                continue
+            item['messages'], item['prompt'] = sheet_template.fill(item['question'], item['answers'], scoring)
+            item['question_id'] = question_id(category, item['question'], item['answers'], item['correct_answer_key'])
+            items.append(item)
+    positions = {item['question_id']: position for position, item in enumerate(items)}
+
+    # Ripresa a livello di domanda: i risultati esistenti vengono letti una sola volta
+    previous, source = load_previous_results(json_filename)
+    index = CompletionIndex(index_filename(json_filename), reset=source is None)
+    done_ids = [record_question_id(record) for record in previous]
+    index.mark(done_ids, 'done')
+    done_ids = set(done_ids)
+    pending_ids = set(index.pending(positions, done_ids, retry_failed))
+    if source is not None:
+        print(f"Ripresa: {len(items) - len(pending_ids)} domande già elaborate, {len(pending_ids)} da elaborare.")
+    if not pending_ids and source == 'json':
+        index.close()
+        return
+    items = [item for item in items if item['question_id'] in pending_ids]
+
+    # Domande già inferite in un altro foglio (deduplicazione della sweep): si copia la risposta senza rifarla
+    reused = []
+    if shared_answers is not None:
+        for item in items:
+            item['dedup_key'] = shared_answers.key(item['question'], item['answers'])
+            answer = shared_answers.lookup(category, item['dedup_key'])
+            if answer is not None:
+                reused.append((item, answer))
+        reused_ids = {item['question_id'] for item, _ in reused}
+        items = [item for item in items if item['question_id'] not in reused_ids]
+        if reused:
+            print(f"{len(reused)} domande copiate da altri fogli, {len(items)} da inferire.")
+
+    generation_kwargs = dict(GREEDY_GENERATION_KWARGS if greedy else GENERATION_KWARGS)
+    grammar = None
+    if constrained and scoring == 'generate':
+        # Il JSON della risposta è lungo pochi token: non serve il budget di 128 token
+        grammar = AnswerGrammar(text_gen_pipeline.tokenizer)
+        generation_kwargs['max_new_tokens'] = grammar.max_new_tokens
+    if response_cache is not None:
+        revision = model_revision(text_gen_pipeline)
+        params = cache_params(scoring, constrained, generation_kwargs, seed)
+    sampling = None
+    if seed is not None and generation_kwargs.get('do_sample'):
+        # Ogni domanda ha un generatore con seed derivato da (seed, prompt): la risposta non dipende
+        # dal batch né da quali domande erano già in cache, come richiesto dalla cache delle risposte
+        sampling = SeededSampling(seed, generation_kwargs)
+        generation_kwargs = sampling.generation_kwargs(generation_kwargs)
+
+    batch_size, max_batch_tokens = resolve_batch_limits(batch_size, max_batch_tokens, text_gen_pipeline)
+    if batch_size != 1 or prefix_cache:
+        # Servono subito i token di tutti i prompt: il prefisso del foglio è tokenizzato una volta sola
+        with PROFILE.stage('tokenize'):
+            for item in items:
+                item['token_ids'] = sheet_template.encode(item['prompt'])
+
+    prefix = None
+    if prefix_cache and items:
+        # Il prefisso comune (template, system prompt, preambolo e categoria) viene calcolato una volta per foglio
+        prefix = PrefixCache(text_gen_pipeline, [item['token_ids'] for item in items])
+        if scoring == 'generate' and batch_size != 1:
+            print("Con --prefix_cache la generazione procede una domanda alla volta.")
+            batch_size = 1
+    # In modalità logits non si genera nulla: basta il forward pass sul prompt
+    reserve_tokens = 1 if scoring == 'logits' else generation_kwargs['max_new_tokens']
+    prepare_tokenizer_for_batching(text_gen_pipeline)
+    if scoring == 'logits':
+        option_token_ids(text_gen_pipeline.tokenizer)
+    if batch_size > 1:
+        # Raggruppa i prompt del foglio di lunghezza simile
+        lengths = [len(item['token_ids']) for item in items]
+        batches = schedule_by_length(lengths, batch_size, max_batch_tokens, reserve_tokens)
+        in_order = list(iter_batches(list(range(len(items))), batch_size))
+        print(f"{len(batches)} batch (max {batch_size} righe, budget {max_batch_tokens or '-'} token). "
+              f"Efficienza padding: {padding_efficiency(lengths, batches):.1%} "
+              f"(in ordine di foglio: {padding_efficiency(lengths, in_order):.1%})")
+    else:
+        batches = [[index] for index in range(len(items))]
+
+    with open_sink(json_filename, sink, fsync_every=fsync_every, resume=source == 'journal') as results, tqdm(total=len(items)) as progress:
+        if source == 'json':
+            # Foglio già completato ripreso con --retry_failed: il giornale riparte dai risultati finali
+            for record in previous:
+                results.write(record)
+        if reused:
+            with PROFILE.stage('write'):
+                for item, answer in reused:
+                    result = make_result(item, category, model, answer['Model Answer'])
+                    if 'Answer Probabilities' in answer:
+                        result['Answer Probabilities'] = answer['Answer Probabilities']
+                    result['Deduplicated From'] = answer['Category']
+                    results.write(result)
+                results.flush()
+                index.mark([item['question_id'] for item, _ in reused], 'done')
+            shared_answers.count_reused(len(reused))
+        # Il tokenizer non è thread-safe: tokenizzazione (preparazione) e decodifica (inferenza) non si sovrappongono
+        tokenizer_lock = threading.Lock()
+
+        def prepare(batch_indices):
+            # Stadio di preparazione: lookup nella cache delle risposte e input paddati del batch.
+            # I prompt sono già costruiti; si tokenizzano qui solo se non servivano prima per formare i batch
+            work = {'indices': batch_indices, 'responses': {}, 'fresh': {}, 'errors': {}}
+            for index in batch_indices:
+                item = items[index]
+                if response_cache is not None:
+                    item['cache_key'] = cache_key(model, revision, item['prompt'], params)
+                    value = response_cache.get(item['cache_key'])
+                    if value is not None:
+                        work['responses'][index] = cached_response(item, value, scoring)
+            work['pending'] = [index for index in batch_indices if index not in work['responses']]
+            work['inputs'] = None
+            if work['pending'] and prefix is None:
+                with tokenizer_lock, PROFILE.stage('tokenize'):
+                    for index in work['pending']:
+                        if 'token_ids' not in items[index]:
+                            items[index]['token_ids'] = sheet_template.encode(items[index]['prompt'])
+                work['inputs'] = pad_token_ids([items[index]['token_ids'] for index in work['pending']], text_gen_pipeline.tokenizer.pad_token_id)
+            return work
+
+        def infer(work):
+            # Stadio di inferenza: l'unico che usa il modello, sul thread principale.
+            # Il batch viene eseguito in blocchi adattati alla memoria; un OOM divide il blocco invece di far fallire le righe.
+            def run_chunk(chunk):
+                inputs = work['inputs']
+                if inputs is not None and chunk != work['pending']:
+                    inputs = pad_token_ids([items[index]['token_ids'] for index in chunk], text_gen_pipeline.tokenizer.pad_token_id)
+                with PROFILE.stage('generation'):
+                    return run_batch(text_gen_pipeline, [items[index] for index in chunk], chunk,
+                                     scoring, generation_kwargs, grammar, prefix, inputs, tokenizer_lock, sampling)
+
+            if work['pending']:
+                lengths = {index: len(items[index]['token_ids']) for index in work['pending']}
+                work['fresh'], work['errors'] = batcher.run(work['pending'], lengths, run_chunk)
+            return work
+
+        def write(work):
+            # Stadio di scrittura: cache, parsing del JSON, giornale e indice delle domande
+            batch = [items[index] for index in work['indices']]
+            for error in dict.fromkeys(work['errors'].values()):
+                print(f"Error in model request: {error}")
+            for position, response in work['fresh'].items():
+                work['responses'][position] = response
+                if response_cache is not None:
+                    value = response if scoring == 'logits' else response[0]['generated_text'][-1]['content']
+                    response_cache.put(items[position]['cache_key'], value)
+            if response_cache is not None and work['fresh']:
+                response_cache.commit()
+
+            done, failed, parsed = [], [], []
+            with PROFILE.stage('parse'):
+                for position, item in zip(work['indices'], batch):
+                    if position in work['errors']:
+                        # Richiesta fallita: la domanda resta nell'indice come fallita e viene ripresa con --retry_failed
+                        failed.append(item['question_id'])
+                        continue
+                    response = work['responses'][position]
+                    try:
+                        if scoring == 'logits':
+                            result = make_result(item, category, model, best_option(response))
+                            result['Answer Probabilities'] = response
+                        else:
+                            result = make_result(item, category, model, parse_response(response))
+                        parsed.append(result)
+                        done.append(item['question_id'])
+                        if shared_answers is not None:
+                            shared_answers.store(category, item['dedup_key'], result)
+                    except Exception as e:
+                        print(f"Error in model request: {e}")
+                        failed.append(item['question_id'])
+            # Le domande risultano completate solo dopo che il loro risultato è sul giornale
+            with PROFILE.stage('write'):
+                for result in parsed:
+                    results.write(result)
+                results.flush()
+                index.mark(done, 'done')
+                index.mark(failed, 'failed')
+            PROFILE.count('questions', len(batch))
+            progress.update(len(batch))
+
+        batcher = AdaptiveBatcher(batch_size, reserve_tokens, lambda: auto_token_budget(text_gen_pipeline))
+        loop = StagedLoop(prepare, infer, write, queue_depth)
+        loop.run(batches)
+
+        with PROFILE.stage('write'):
+            results.finalize(sort_key=lambda record: positions.get(record_question_id(record), len(positions)))
+
+    print(f"Indice domande: {index.count('done')} completate, {index.count('failed')} fallite.")
+    index.close()
+
+    loop.report()
+    if batch_size > 1 or batcher.backoffs:
+        batcher.report()
+    if prefix is not None:
+        prefix.report()
+    if response_cache is not None:
+        response_cache.report()
     print(f'Updated results for sheet "{category}" in {json_filename}')
 
-def initialize_model(model):
-    global model_initialized, text_gen_pipeline
+def output_filename(sheet_name, model):
+    return f"{sheet_name.replace(' ', '-').replace(',','')}_{model.split('/')[-1]}_MC.json"
+
+def initialize_model(model, quantization='4bit', model_store=DEFAULT_MODEL_STORE, no_model_store=False):
+    global model_initialized, text_gen_pipeline, loaded_model
+    if model_initialized and loaded_model != model:
+        release_model()
     if not model_initialized:
         print("Initializing the model...")
-        text_gen_pipeline = pipeline("text-generation",
-                                     model=model,
-                                     model_kwargs={
-                                        "torch_dtype": torch.float16,
-                                        "quantization_config": {"load_in_4bit": True}
-                                      },
-                                    )
+        text_gen_pipeline = load_pipeline(model, quantization, model_store, use_store=not no_model_store)
         model_initialized = True
+        loaded_model = model
         print("Model initialized.")
+    return text_gen_pipeline
+
+def release_model():
+    # Libera i pesi del modello corrente prima di caricarne un altro
+    global model_initialized, text_gen_pipeline, loaded_model
+    if not model_initialized:
+        return
+    print(f"Rilascio del modello {loaded_model}...")
+    text_gen_pipeline = None
+    model_initialized = False
+    loaded_model = None
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def open_response_cache(no_cache, cache_path, cache_max_mb, scoring='generate', greedy=False, seed=None):
+    # Una run campionata senza seed non è riproducibile e non viene messa in cache
+    if no_cache or not (scoring == 'logits' or greedy or seed is not None):
+        return None
+    return ResponseCache(cache_path, cache_max_mb)
 
-def main(excel_path, category, model):
+def add_model_arguments(parser):
+    # Opzioni di caricamento del modello comuni a questo script e a script_MC_sweep.py
+    parser.add_argument('--quantization', choices=list(QUANTIZATION_CONFIGS), default='4bit', help="Quantizzazione applicata al caricamento del checkpoint originale.")
+    parser.add_argument('--model_store', default=DEFAULT_MODEL_STORE, help="Cartella in cui ogni modello viene salvato una volta già quantizzato e da cui viene ricaricato.")
+    parser.add_argument('--no_model_store', action='store_true', help="Carica sempre dal checkpoint originale, senza usare né aggiornare la cartella dei modelli.")
+
+def add_processing_arguments(parser):
+    # Opzioni di process_sheet comuni a questo script e a script_MC_sweep.py
+    parser.add_argument('--workbook_cache', default=DEFAULT_WORKBOOK_CACHE, help="Cartella della copia colonnare (Arrow) del file Excel, rigenerata quando il file cambia.")
+    parser.add_argument('--sink', choices=sorted(SINKS), default='jsonl', help="Formato di scrittura incrementale dei risultati.")
+    parser.add_argument('--fsync_every', type=int, default=0, help="Esegui fsync ogni N risultati scritti (0 = solo a fine foglio).")
+    parser.add_argument('--batch_size', type=parse_batch_size, default=1, help="Numero di domande generate insieme, oppure 'auto' per sceglierlo dalla memoria libera.")
+    parser.add_argument('--greedy', action='store_true', help="Decodifica greedy (deterministica) invece del campionamento.")
+    parser.add_argument('--max_batch_tokens', type=int, default=None, help="Budget di token per batch (righe x prompt più lungo, generazione inclusa).")
+    parser.add_argument('--scoring', choices=SCORING_MODES, default='generate', help="generate: risposta JSON generata; logits: lettera più probabile dal prossimo token, con le probabilità di A-E nel risultato.")
+    parser.add_argument('--constrained', action='store_true', help="Vincola la generazione al formato {\"answer\": \"<A-E>\"} e fermala alla graffa di chiusura.")
+    parser.add_argument('--prefix_cache', action='store_true', help="Calcola una volta per foglio la KV cache del prefisso comune dei prompt e riusala per ogni domanda.")
+    parser.add_argument('--queue_depth', type=int, default=DEFAULT_QUEUE_DEPTH, help="Batch preparati in anticipo e in attesa di scrittura tra gli stadi della pipeline.")
+    parser.add_argument('--retry_failed', action='store_true', help="Rielabora anche le domande fallite nelle run precedenti, pure nei fogli già completati.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed per le run campionate; senza seed le run campionate non usano la cache.")
+    parser.add_argument('--no_cache', action='store_true', help="Ignora la cache persistente delle risposte.")
+    parser.add_argument('--cache_path', default=DEFAULT_CACHE_PATH, help="File SQLite della cache delle risposte.")
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_MAX_MB, help="Dimensione massima della cache; oltre vengono eliminate le voci usate meno di recente.")
+
+def main(excel_path, category, model, no_cache=False, cache_path=DEFAULT_CACHE_PATH, cache_max_mb=DEFAULT_MAX_MB, workbook_cache=DEFAULT_WORKBOOK_CACHE,
+         quantization='4bit', model_store=DEFAULT_MODEL_STORE, no_model_store=False, **options):
     print("Sono in script_MC_new...")
-    initialize_model(model)
+    initialize_model(model, quantization, model_store, no_model_store)
+    response_cache = open_response_cache(no_cache, cache_path, cache_max_mb, options.get('scoring', 'generate'), options.get('greedy', False), options.get('seed'))
 
     if category.lower() == "all":
-        sheets = pd.read_excel(excel_path, sheet_name=None)
+        sheets = load_workbook(excel_path, cache_dir=workbook_cache)
         for sheet_name, df in sheets.items():
-            json_filename = f"{sheet_name.replace(' ', '-').replace(',','')}_{model.split('/')[-1]}_MC.json"
-            if os.path.exists(json_filename):
+            json_filename = output_filename(sheet_name, model)
+            if os.path.exists(json_filename) and not options.get('retry_failed'):
                 print(f"Saltato foglio '{sheet_name}' perché il file di output '{json_filename}' esiste già.")
             else:
                 print(f"Elaborazione foglio '{sheet_name}'...")
-                process_sheet(df, sheet_name, model, json_filename, text_gen_pipeline)
+                process_sheet(df, sheet_name, model, json_filename, text_gen_pipeline, response_cache=response_cache, **options)
     else:
-        df = pd.read_excel(excel_path, sheet_name=category)
-        json_filename = f"{category.replace(' ', '-').replace(',','')}_{model.split('/')[-1]}_MC.json"
-        if os.path.exists(json_filename):
+        df = load_workbook(excel_path, [category], cache_dir=workbook_cache)[category]
+        json_filename = output_filename(category, model)
+        if os.path.exists(json_filename) and not options.get('retry_failed'):
             print(f"Saltato foglio '{category}' perché il file di output '{json_filename}' esiste già.")
         else:
-            process_sheet(df, category, model, json_filename, text_gen_pipeline)
+            process_sheet(df, category, model, json_filename, text_gen_pipeline, response_cache=response_cache, **options)
+
+    if response_cache is not None:
+        response_cache.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Esegui lo script per elaborare un file Excel e generare le risposte.")
     parser.add_argument('--excel_path', help="Percorso del file Excel.", required=True)
     parser.add_argument('--category', help="Nome del foglio di lavoro o 'all' per tutti i fogli.", required=True)
     parser.add_argument('--model', help="Nome del modello da utilizzare.", required=True)
+    add_model_arguments(parser)
+    add_processing_arguments(parser)
 
     args = parser.parse_args()
-    main(args.excel_path, args.category, args.model)
+    main(**vars(args))
@@ -0,0 +1,98 @@
+import argparse
+import time
+import os
+
+from script_MC_new import initialize_model, release_model, process_sheet, output_filename, add_model_arguments, add_processing_arguments, open_response_cache
+from response_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_MB
+from ingestion import load_workbook, sheet_names, DEFAULT_WORKBOOK_CACHE
+from model_store import DEFAULT_MODEL_STORE
+from parallel import run_parallel_sweep, DEFAULT_SHARD_SIZE
+from dedup import DedupIndex, SharedAnswers
+
+
+def load_sheets(excel_path, categories, workbook_cache=DEFAULT_WORKBOOK_CACHE):
+    # Legge i fogli dalla cache colonnare del file Excel, una sola volta per tutta la sweep
+    available = sheet_names(excel_path, workbook_cache)
+    if len(categories) == 1 and categories[0].lower() == "all":
+        categories = available
+
+    requested = []
+    for category in categories:
+        if category in requested:
+            continue
+        if category not in available:
+            print(f"Attenzione: il foglio '{category}' non esiste in {excel_path}, saltato.")
+            continue
+        requested.append(category)
+    return load_workbook(excel_path, requested, workbook_cache)
+
+
+def run_sweep(excel_path, models, categories, no_cache=False, cache_path=DEFAULT_CACHE_PATH, cache_max_mb=DEFAULT_MAX_MB, workbook_cache=DEFAULT_WORKBOOK_CACHE,
+              quantization='4bit', model_store=DEFAULT_MODEL_STORE, no_model_store=False,
+              workers=1, threads_per_worker=0, shard_size=DEFAULT_SHARD_SIZE, gpus=None, dedup=False, **options):
+    sheets = load_sheets(excel_path, categories, workbook_cache)
+    dedup_index = None
+    if dedup:
+        dedup_index = DedupIndex(sheets)
+        dedup_index.report()
+    if workers > 1:
+        if dedup:
+            # I fogli sono divisi in shard tra processi diversi: non c'è un ordine in cui il foglio canonico precede le copie
+            print("Attenzione: --dedup non è supportato con --workers > 1 e viene ignorato.")
+        # Ogni worker apre la propria connessione alla cache delle risposte
+        cache_options = {
+            'no_cache': no_cache, 'cache_path': cache_path, 'cache_max_mb': cache_max_mb,
+            'scoring': options.get('scoring', 'generate'), 'greedy': options.get('greedy', False), 'seed': options.get('seed')
+        }
+        model_options = {'quantization': quantization, 'model_store': model_store, 'no_model_store': no_model_store}
+        run_parallel_sweep(excel_path, sheets, models, workers, threads_per_worker, shard_size, gpus, workbook_cache, cache_options, model_options, **options)
+        return
+
+    response_cache = open_response_cache(no_cache, cache_path, cache_max_mb, options.get('scoring', 'generate'), options.get('greedy', False), options.get('seed'))
+
+    for model in models:
+        pending = {
+            name: df for name, df in sheets.items()
+            if options.get('retry_failed') or not os.path.exists(output_filename(name, model))
+        }
+        if not pending:
+            print(f"Saltato modello '{model}': tutti i fogli richiesti hanno già un file di output.")
+            continue
+
+        print(f"Modello '{model}': {len(pending)} fogli da elaborare.")
+        start = time.perf_counter()
+        text_gen_pipeline = initialize_model(model, quantization, model_store, no_model_store)
+        print(f"Modello caricato in {time.perf_counter() - start:.1f}s")
+        shared_answers = SharedAnswers(dedup_index, model) if dedup_index is not None else None
+        try:
+            for sheet_name, df in pending.items():
+                print(f"Elaborazione foglio '{sheet_name}'...")
+                process_sheet(df, sheet_name, model, output_filename(sheet_name, model), text_gen_pipeline,
+                              response_cache=response_cache, shared_answers=shared_answers, **options)
+        finally:
+            # Il riferimento locale va eliminato prima del rilascio, altrimenti i pesi restano in memoria
+            del text_gen_pipeline
+            release_model()
+        if shared_answers is not None:
+            shared_answers.report(model)
+        print(f"Modello '{model}' completato in {time.perf_counter() - start:.1f}s")
+
+    if response_cache is not None:
+        response_cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Esegui tutte le combinazioni modello x categoria caricando ogni modello una sola volta.")
+    parser.add_argument('--excel_path', help="Percorso del file Excel.", required=True)
+    parser.add_argument('--models', nargs='+', help="Nomi dei modelli da utilizzare, in ordine.", required=True)
+    parser.add_argument('--categories', nargs='+', help="Nomi dei fogli di lavoro oppure 'all' per tutti i fogli.", required=True)
+    add_model_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1, help="Numero di processi worker, ognuno con la propria istanza del modello (1 = esecuzione seriale).")
+    parser.add_argument('--threads_per_worker', type=int, default=0, help="Thread di calcolo per worker (0 = core disponibili divisi per il numero di worker).")
+    parser.add_argument('--shard_size', type=int, default=DEFAULT_SHARD_SIZE, help="Righe per shard nella modalità parallela.")
+    parser.add_argument('--dedup', action='store_true', help="Inferisci una sola volta le domande ripetute in più fogli e copia la risposta negli altri file di output.")
+    parser.add_argument('--gpus', nargs='+', default=None, help="Indici delle GPU assegnate ai worker a rotazione.")
+    add_processing_arguments(parser)
+
+    args = parser.parse_args()
+    run_sweep(**vars(args))
@@ -0,0 +1,146 @@
+import queue
+import threading
+import time
+
+DEFAULT_QUEUE_DEPTH = 2
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.batches = 0
+
+
+class QueueStats:
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+
+class StagedLoop:
+    # Tre stadi collegati da code limitate: preparazione (thread), inferenza (thread chiamante, che possiede
+    # il modello) e scrittura (thread). Il modello non aspetta la cache delle risposte, il padding né il disco,
+    # e le code limitate impediscono alla preparazione di andare troppo avanti rispetto all'inferenza.
+
+    def __init__(self, prepare, infer, write, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.prepare = prepare
+        self.infer = infer
+        self.write = write
+        self.stages = {name: StageStats(name) for name in ['preparazione', 'inferenza', 'scrittura']}
+        self.queues = {
+            'preparati': QueueStats('preparati', queue_depth),
+            'da scrivere': QueueStats('da scrivere', queue_depth),
+        }
+        self._prepared = queue.Queue(maxsize=queue_depth)
+        self._to_write = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, target, stats, stage, item):
+        # put con timeout: se un altro stadio si è fermato per un errore non si resta bloccati sulla coda piena
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stage.waiting += time.perf_counter() - start
+        stats.sample(target.qsize())
+
+    def _get(self, source, stage):
+        start = time.perf_counter()
+        while True:
+            try:
+                item = source.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self._stop.is_set():
+                    item = _DONE
+                    break
+        stage.waiting += time.perf_counter() - start
+        return item
+
+    def _finish(self, target):
+        # Segnala la fine allo stadio successivo; se la pipeline è già ferma per un errore si rinuncia
+        while True:
+            try:
+                target.put(_DONE, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stop.is_set():
+                    return
+
+    def _produce(self, batches):
+        stage = self.stages['preparazione']
+        try:
+            for batch in batches:
+                if self._stop.is_set():
+                    break
+                start = time.perf_counter()
+                work = self.prepare(batch)
+                stage.busy += time.perf_counter() - start
+                stage.batches += 1
+                self._put(self._prepared, self.queues['preparati'], stage, work)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._finish(self._prepared)
+
+    def _consume(self, function, stage, source, target=None, target_stats=None):
+        # Lo stadio di scrittura svuota la coda anche dopo un errore dell'inferenza:
+        # i risultati già calcolati finiscono comunque sul giornale
+        try:
+            while True:
+                work = self._get(source, stage)
+                if work is _DONE or (target is not None and self._stop.is_set()):
+                    break
+                start = time.perf_counter()
+                result = function(work)
+                stage.busy += time.perf_counter() - start
+                stage.batches += 1
+                if target is not None:
+                    self._put(target, target_stats, stage, result)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            if target is not None:
+                self._finish(target)
+
+    def run(self, batches):
+        producer = threading.Thread(target=self._produce, args=(batches,), daemon=True)
+        writer = threading.Thread(target=self._consume, args=(self.write, self.stages['scrittura'], self._to_write), daemon=True)
+        producer.start()
+        writer.start()
+        try:
+            self._consume(self.infer, self.stages['inferenza'], self._prepared, self._to_write, self.queues['da scrivere'])
+        finally:
+            writer.join()
+            # Il produttore può essere fermo su una coda piena: lo sblocca lo stop
+            self._stop.set()
+            producer.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def report(self):
+        stages = ', '.join(
+            f"{stage.name} {stage.busy:.1f}s (attesa {stage.waiting:.1f}s)" for stage in self.stages.values()
+        )
+        queues = ', '.join(
+            f"coda {stats.name} media {stats.total_depth / stats.samples if stats.samples else 0:.1f}/{stats.maxsize} (max {stats.max_depth})"
+            for stats in self.queues.values()
+        )
+        print(f"Pipeline: {stages}; {queues}")